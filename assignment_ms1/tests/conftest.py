@@ -0,0 +1,30 @@
+import os
+import sys
+import struct
+
+import pytest
+
+# The package is run from the assignment_ms1 directory, so the tests import it from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wav_file_manager.database import create_database, close_connections
+
+
+# Function to build the bytes of a wav file. fmt_extra is appended to the 16-byte fmt chunk and data_size
+# overrides the size the data chunk declares, to build damaged files.
+def wav_bytes(frames=b'', channels=1, frame_rate=8000, sample_width=2, format_tag=1, fmt_extra=b'', data_size=None, with_data=True, with_fmt=True):
+    block_align = channels * sample_width
+    chunks = b''
+    if with_fmt:
+        fmt = struct.pack('<HHIIHH', format_tag, channels, frame_rate, frame_rate * block_align, block_align, sample_width * 8) + fmt_extra
+        chunks += b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    if with_data:
+        chunks += b'data' + struct.pack('<I', len(frames) if data_size is None else data_size) + frames
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+@pytest.fixture
+def database_name(tmp_path):
+    database_name = str(tmp_path / "test.db")
+    create_database(database_name)
+    yield database_name
+    close_connections()
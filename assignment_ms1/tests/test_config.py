@@ -0,0 +1,38 @@
+import pytest
+
+from wav_file_manager import config
+from wav_file_manager.config import parse_encoding_profiles, parse_retention_policies
+
+
+def test_encoding_profiles():
+    assert parse_encoding_profiles('archive=mp3:128k, transcribe=opus:24k:1:16000') == [
+        ('archive', 'mp3', '128k', None, None),
+        ('transcribe', 'opus', '24k', 1, 16000),
+    ]
+    assert parse_encoding_profiles('low=mp3:32k::22050') == [('low', 'mp3', '32k', None, 22050)]
+
+def test_default_encoding_profile():
+    assert parse_encoding_profiles('') == [(None, 'mp3', config.mp3_bitrate, None, None)]
+
+@pytest.mark.parametrize('value', ['mp3:128k', '=mp3:128k', 'a=wav:128k', 'a=mp3', 'a=mp3:', 'a=mp3:128k:x', 'a=mp3:128k:1:8000:9'])
+def test_invalid_encoding_profiles(value):
+    with pytest.raises(ValueError, match="invalid encoding profile"):
+        parse_encoding_profiles(value)
+
+def test_duplicate_encoding_profile_names():
+    with pytest.raises(ValueError, match="duplicate encoding profile name 'archive'"):
+        parse_encoding_profiles('archive=mp3:128k,archive=opus:24k')
+
+def test_retention_policies(monkeypatch):
+    for artifact in ('ORIGINAL', 'CONVERTED', 'CHUNKS'):
+        monkeypatch.delenv(f'RETENTION_{artifact}', raising=False)
+    assert parse_retention_policies() == {}
+    monkeypatch.setenv('RETENTION_ORIGINAL', 'delete:30')
+    monkeypatch.setenv('RETENTION_CHUNKS', 'archive:7')
+    assert parse_retention_policies() == {'original': ('delete', 30), 'chunks': ('archive', 7)}
+
+@pytest.mark.parametrize('policy', ['delete', 'keep:3', 'archive:-1', 'delete:x'])
+def test_invalid_retention_policies(monkeypatch, policy):
+    monkeypatch.setenv('RETENTION_CONVERTED', policy)
+    with pytest.raises(ValueError, match="invalid retention policy"):
+        parse_retention_policies()
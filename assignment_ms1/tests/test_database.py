@@ -0,0 +1,57 @@
+import sqlite3
+
+import pytest
+
+from wav_file_manager.database import get_connection, schema_migrations, migrate_database
+
+
+def test_profiles_sharing_a_format_keep_their_rows(database_name):
+    conn = get_connection(database_name)
+    rows = [(f"completed/251014/call/{artifact}/{profile}/{file_name}", file_name)
+            for profile in ('archive', 'low') for artifact, file_name in (('converted', 'call.mp3'), ('chunks', 'call_0-10.mp3'))]
+    with conn:
+        conn.executemany("INSERT INTO ProcessedFiles (local_file_path, source_file_name, status) VALUES (?, ?, 'processed')", rows)
+    assert conn.execute("SELECT local_file_path, source_file_name FROM ProcessedFiles ORDER BY id").fetchall() == rows
+
+def test_colliding_paths_fail_instead_of_replacing(database_name):
+    conn = get_connection(database_name)
+    with conn:
+        conn.execute("INSERT INTO ProcessedFiles (local_file_path, source_file_name) VALUES ('completed/251014/call/converted/call.mp3', 'call.mp3')")
+    with pytest.raises(sqlite3.IntegrityError):
+        with conn:
+            conn.execute("INSERT INTO ProcessedFiles (local_file_path, source_file_name) VALUES ('completed/251014/call/converted/call.mp3', 'call.mp3')")
+
+def test_unique_file_names_are_dropped_from_older_databases(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "old.db"))
+    for migration in schema_migrations[:10]:
+        migration(conn.cursor())
+    conn.execute("PRAGMA user_version = 10")
+    conn.execute("INSERT INTO ProcessedFiles (local_file_path, source_file_name, chunk_start_ms) VALUES ('a/call.mp3', 'call.mp3', 0)")
+    conn.commit()
+    migrate_database(conn)
+    conn.execute("INSERT INTO ProcessedFiles (local_file_path, source_file_name) VALUES ('b/call.mp3', 'call.mp3')")
+    assert conn.execute("SELECT local_file_path, chunk_start_ms FROM ProcessedFiles ORDER BY id").fetchall() == [('a/call.mp3', 0), ('b/call.mp3', None)]
+    conn.close()
+
+def test_changed_days_are_marked_for_the_report(database_name):
+    conn = get_connection(database_name)
+    with conn:
+        conn.execute("INSERT INTO SourceFile (source_file_name, status, created_date) VALUES ('call.wav', 'pending', '25-10-14')")
+        conn.execute("INSERT INTO SourceFile (source_file_name, status, created_date) VALUES ('other.wav', 'pending', '25-10-15')")
+        conn.execute("DELETE FROM ReportDirtyDate")
+        conn.execute("UPDATE SourceFile SET status = 'completed' WHERE source_file_name = 'call.wav'")
+        # Chunk rows match no SourceFile row and mark nothing
+        conn.execute("INSERT INTO ProcessedFiles (local_file_path, source_file_name) VALUES ('c/call_0-10.mp3', 'call_0-10.mp3')")
+    assert conn.execute("SELECT report_date FROM ReportDirtyDate").fetchall() == [('25-10-14',)]
+
+def test_report_partitions_keep_their_rows_without_the_fingerprint(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "old.db"))
+    for migration in schema_migrations[:12]:
+        migration(conn.cursor())
+    conn.execute("PRAGMA user_version = 12")
+    conn.execute("INSERT INTO ReportPartition (report_date, fingerprint, report_file, rendered_date) VALUES ('25-10-14', NULL, 'r.csv', '25-10-15')")
+    conn.commit()
+    migrate_database(conn)
+    assert [row[1] for row in conn.execute("PRAGMA table_info(ReportPartition)")] == ['report_date', 'report_file', 'rendered_date']
+    assert conn.execute("SELECT * FROM ReportPartition").fetchall() == [('25-10-14', 'r.csv', '25-10-15')]
+    conn.close()
@@ -0,0 +1,81 @@
+import pytest
+
+from wav_file_manager import config
+from wav_file_manager.database import get_connection
+from wav_file_manager.jobs import enqueue_jobs, claim_jobs, renew_leases, finish_job
+
+
+@pytest.fixture
+def queued_file(database_name, tmp_path):
+    wav_file_path = tmp_path / "input" / "251014" / "call.wav"
+    wav_file_path.parent.mkdir(parents=True)
+    wav_file_path.write_bytes(b'')
+    conn = get_connection(database_name)
+    with conn:
+        conn.execute("INSERT INTO SourceFile (source_file_name, status, checksum) VALUES ('call.wav', 'pending', 'abc')")
+        enqueue_jobs(conn, [(str(wav_file_path), "251014")])
+    return str(wav_file_path)
+
+def job_state(database_name):
+    return get_connection(database_name).execute("SELECT state, owner, attempts FROM ConversionJob").fetchone()
+
+def test_claimed_job_is_not_claimed_again(database_name, queued_file, tmp_path):
+    jobs = claim_jobs(database_name, "host:1", str(tmp_path / "processing"), 5)
+    assert [(wav_file_path, main_folder_name, checksum) for _, wav_file_path, main_folder_name, checksum in jobs] == [(queued_file, "251014", "abc")]
+    assert claim_jobs(database_name, "host:2", str(tmp_path / "processing"), 5) == []
+    assert job_state(database_name) == ('leased', 'host:1', 1)
+
+def test_expired_lease_is_queued_again(database_name, queued_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'job_lease_seconds', -1)
+    [(job_id, _, _, _)] = claim_jobs(database_name, "host:1", str(tmp_path / "processing"), 1)
+    # The lease has already expired, so the next claim queues the job again and takes it over
+    [(reclaimed_job_id, _, _, _)] = claim_jobs(database_name, "host:2", str(tmp_path / "processing"), 1)
+    assert reclaimed_job_id == job_id
+    assert job_state(database_name) == ('leased', 'host:2', 2)
+    # The first worker lost its lease and cannot renew it
+    assert renew_leases(database_name, "host:1", [job_id]) == 0
+
+def test_job_fails_after_max_attempts(database_name, queued_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'job_lease_seconds', -1)
+    monkeypatch.setattr(config, 'job_max_attempts', 2)
+    processing_folder = str(tmp_path / "processing")
+    assert len(claim_jobs(database_name, "host:1", processing_folder, 1)) == 1
+    assert len(claim_jobs(database_name, "host:1", processing_folder, 1)) == 1
+    assert claim_jobs(database_name, "host:1", processing_folder, 1) == []
+    assert job_state(database_name) == ('failed', None, 2)
+    assert get_connection(database_name).execute("SELECT status FROM SourceFile").fetchone() == ('failed',)
+
+def test_requeued_job_recovers_file_from_processing(database_name, queued_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'job_lease_seconds', -1)
+    processing_folder = tmp_path / "processing"
+    claim_jobs(database_name, "host:1", str(processing_folder), 1)
+    # The worker died after moving the original into its recording folder
+    stranded_file_path = processing_folder / "251014" / "call" / "original" / "call.wav"
+    stranded_file_path.parent.mkdir(parents=True)
+    (tmp_path / "input" / "251014" / "call.wav").rename(stranded_file_path)
+    [(_, wav_file_path, _, _)] = claim_jobs(database_name, "host:2", str(processing_folder), 1)
+    assert wav_file_path == queued_file
+    assert not stranded_file_path.exists()
+
+def test_finished_job_can_be_queued_again(database_name, queued_file, tmp_path):
+    [(job_id, _, _, _)] = claim_jobs(database_name, "host:1", str(tmp_path / "processing"), 1)
+    conn = get_connection(database_name)
+    with conn:
+        finish_job(conn, job_id, "host:1", 'completed')
+        # Queueing a file that is already queued or leased leaves it alone, a finished one is queued afresh
+        enqueue_jobs(conn, [(queued_file, "251014")])
+    assert job_state(database_name) == ('queued', None, 0)
+
+def test_late_finish_leaves_a_reclaimed_job_alone(database_name, queued_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'job_lease_seconds', -1)
+    [(job_id, _, _, _)] = claim_jobs(database_name, "host:1", str(tmp_path / "processing"), 1)
+    claim_jobs(database_name, "host:2", str(tmp_path / "processing"), 1)
+    conn = get_connection(database_name)
+    with conn:
+        finish_job(conn, job_id, "host:1", 'completed')
+    assert job_state(database_name) == ('leased', 'host:2', 2)
+    # Once the job is queued again without an owner, the late finish completes it
+    with conn:
+        conn.execute("UPDATE ConversionJob SET state = 'queued', owner = NULL")
+        finish_job(conn, job_id, "host:1", 'completed')
+    assert job_state(database_name) == ('completed', None, 2)
@@ -0,0 +1,55 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from wav_file_manager import config
+from wav_file_manager.silence import frame_energies_db, silence_chunk_boundaries
+
+
+@pytest.fixture(autouse=True)
+def silence_settings(monkeypatch):
+    monkeypatch.setattr(config, 'silence_frame_ms', 20)
+    monkeypatch.setattr(config, 'silence_min_chunk_ms', 5000)
+    monkeypatch.setattr(config, 'silence_max_chunk_ms', 15000)
+    monkeypatch.setattr(config, 'silence_threshold_db', -40)
+
+# Function to build frame energies: loud everywhere except the quiet spans, given as (start ms, end ms)
+def energies(duration_ms, quiet_spans=(), level_db=-10.0):
+    energy_db = np.full(duration_ms // config.silence_frame_ms, level_db)
+    for start_ms, end_ms in quiet_spans:
+        energy_db[start_ms // config.silence_frame_ms:end_ms // config.silence_frame_ms] = -80.0
+    return energy_db
+
+def test_short_recording_is_one_chunk():
+    assert silence_chunk_boundaries(energies(12000), 12000) == ([(0, 12000)], [False])
+
+def test_cuts_land_in_pauses():
+    boundaries, silent_chunks = silence_chunk_boundaries(energies(30000, [(8000, 8400), (19000, 19400)]), 30000)
+    assert len(boundaries) == 3
+    assert 8000 <= boundaries[0][1] <= 8400
+    assert 19000 <= boundaries[1][1] <= 19400
+    # The chunks cover the recording without gaps
+    assert boundaries[0][0] == 0 and boundaries[-1][1] == 30000
+    assert all(end_ms == next_start_ms for (_, end_ms), (next_start_ms, _) in zip(boundaries, boundaries[1:]))
+    assert silent_chunks == [False, False, False]
+
+def test_chunk_lengths_stay_within_the_window():
+    boundaries, _ = silence_chunk_boundaries(energies(100000), 100000)
+    lengths = [end_ms - start_ms for start_ms, end_ms in boundaries]
+    assert all(5000 - config.silence_frame_ms <= length <= 15000 + config.silence_frame_ms for length in lengths)
+
+def test_silent_chunks_are_flagged():
+    boundaries, silent_chunks = silence_chunk_boundaries(energies(30000, [(15000, 30000)]), 30000)
+    assert silent_chunks[-1] and not silent_chunks[0]
+
+def test_frame_energies_span_buffers():
+    frame_rate = 8000
+    tone = (np.sin(np.arange(frame_rate) * 0.3) * 16000).astype('<i2')
+    silence = np.zeros(frame_rate, dtype='<i2')
+    pcm = np.concatenate((tone, silence)).tobytes()
+    # Buffers that split analysis frames give the same energies as one buffer
+    split = frame_energies_db([pcm[:3001 * 2], pcm[3001 * 2:]], 2, 1, frame_rate)
+    whole = frame_energies_db([pcm], 2, 1, frame_rate)
+    assert np.allclose(split, whole)
+    assert len(whole) == 100
+    assert whole[:50].min() > -10 and whole[50:].max() < -90
@@ -0,0 +1,77 @@
+import struct
+
+import pytest
+
+from wav_file_manager import config
+from wav_file_manager.validate import read_wav_header, is_streamable, wave_format_extensible
+from conftest import wav_bytes
+
+
+def write_wav(tmp_path, data):
+    wav_file_path = tmp_path / "call.wav"
+    wav_file_path.write_bytes(data)
+    return str(wav_file_path)
+
+def test_reads_pcm_header(tmp_path):
+    wav_file_path = write_wav(tmp_path, wav_bytes(b'\x00\x01' * 8000, channels=2, frame_rate=4000))
+    format_tag, channels, frame_rate, sample_width, data_offset, data_bytes, duration_ms = read_wav_header(wav_file_path)
+    assert (format_tag, channels, frame_rate, sample_width) == (1, 2, 4000, 2)
+    assert (data_offset, data_bytes, duration_ms) == (44, 16000, 1000)
+    assert is_streamable(read_wav_header(wav_file_path))
+
+def test_skips_chunks_before_data(tmp_path):
+    data = wav_bytes(b'\x00\x00' * 800)
+    # A LIST chunk of odd size between fmt and data, padded to an even size
+    list_chunk = b'LIST' + struct.pack('<I', 3) + b'abc\x00'
+    data = data[:36] + list_chunk + data[36:]
+    data = data[:4] + struct.pack('<I', len(data) - 8) + data[8:]
+    header = read_wav_header(write_wav(tmp_path, data))
+    assert header[4] == 44 + len(list_chunk)
+    assert header[6] == 100
+
+def test_extensible_format_uses_sub_format(tmp_path):
+    # cbSize, valid bits, channel mask and the SubFormat GUID starting with the float format tag
+    fmt_extra = struct.pack('<HHI', 22, 32, 4) + struct.pack('<H', 3) + b'\x00' * 14
+    header = read_wav_header(write_wav(tmp_path, wav_bytes(b'\x00' * 3200, sample_width=4, format_tag=wave_format_extensible, fmt_extra=fmt_extra)))
+    assert header[0] == 3
+    assert not is_streamable(header)
+
+def test_rejects_truncated_data_chunk(tmp_path):
+    data = wav_bytes(b'\x00\x00' * 800, data_size=3200)
+    # The RIFF size matches the file, only the data chunk claims more than there is
+    with pytest.raises(ValueError, match="truncated: data chunk"):
+        read_wav_header(write_wav(tmp_path, data))
+
+def test_rejects_truncated_file(tmp_path):
+    data = wav_bytes(b'\x00\x00' * 800)
+    with pytest.raises(ValueError, match="truncated: RIFF header"):
+        read_wav_header(write_wav(tmp_path, data[:-100]))
+
+def test_rejects_missing_data_chunk(tmp_path):
+    with pytest.raises(ValueError, match="no data chunk"):
+        read_wav_header(write_wav(tmp_path, wav_bytes(with_data=False)))
+
+def test_rejects_missing_fmt_chunk(tmp_path):
+    with pytest.raises(ValueError, match="no fmt chunk"):
+        read_wav_header(write_wav(tmp_path, wav_bytes(with_fmt=False, with_data=False)))
+
+def test_rejects_non_wave_and_short_files(tmp_path):
+    with pytest.raises(ValueError, match="not a RIFF/WAVE file"):
+        read_wav_header(write_wav(tmp_path, b'ID3' + b'\x00' * 100))
+    with pytest.raises(ValueError, match="too short"):
+        read_wav_header(write_wav(tmp_path, b'RIFF'))
+
+def test_rejects_unsupported_format(tmp_path):
+    # A-law
+    with pytest.raises(ValueError, match="unsupported format tag"):
+        read_wav_header(write_wav(tmp_path, wav_bytes(b'\x00' * 800, sample_width=1, format_tag=6)))
+
+def test_duration_limits(tmp_path, monkeypatch):
+    wav_file_path = write_wav(tmp_path, wav_bytes(b'\x00\x00' * 8000))
+    monkeypatch.setattr(config, 'wav_min_duration_ms', 2000)
+    with pytest.raises(ValueError, match="shorter than"):
+        read_wav_header(wav_file_path)
+    monkeypatch.setattr(config, 'wav_min_duration_ms', 1)
+    monkeypatch.setattr(config, 'wav_max_duration_ms', 500)
+    with pytest.raises(ValueError, match="longer than"):
+        read_wav_header(wav_file_path)
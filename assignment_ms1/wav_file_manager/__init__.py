@@ -0,0 +1,5 @@
+# WAV file manager: downloads WAV recordings from the remote server, converts them to mp3 and chunks,
+# keeps their state in a SQLite database, and reports and emails the daily status.
+#
+# The stages live in their own modules (sync, convert, pipeline, report, notify) and are run through
+# the command line in cli; nothing is imported or done here, so `import wav_file_manager` is cheap.
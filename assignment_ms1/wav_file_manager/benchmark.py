@@ -0,0 +1,362 @@
+import os
+import sys
+import json
+import math
+import time
+import wave
+import array
+import shlex
+import base64
+import random
+import shutil
+import socket
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import socketserver
+from datetime import datetime
+
+import paramiko
+
+from . import config
+
+
+# End-to-end benchmark of the daily job without the production server or Gmail: a synthetic WAV corpus is
+# served by a local paramiko SFTP server, the status email goes to a local SMTP sink, and every stage is
+# timed in a scratch work folder. Run it with `python -m wav_file_manager.benchmark`; the conversion,
+# download and chunking settings are read from the environment as usual, so runs can be compared.
+
+# Function to build one period of a 16-bit sine tone, repeated to fill a stretch of speech-like sound
+def tone_period(frequency, sample_rate, channels):
+    period_samples = max(2, sample_rate // frequency)
+    samples = array.array('h', (int(12000 * math.sin(2 * math.pi * index / period_samples)) for index in range(period_samples)
+                                for _ in range(channels)))
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+# Function to write a synthetic 16-bit recording of duration_s: tone bursts of 1-6 seconds separated by
+# pauses of 0.2-1.5 seconds, so silence chunking has cut points to find. Written a burst at a time.
+def write_synthetic_wav(wav_file_path, duration_s, sample_rate, channels, rng):
+    frame_bytes = 2 * channels
+    remaining_frames = int(duration_s * sample_rate)
+    with wave.open(wav_file_path, 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        speaking = True
+        while remaining_frames > 0:
+            frame_count = min(remaining_frames, int(sample_rate * (rng.uniform(1, 6) if speaking else rng.uniform(0.2, 1.5))))
+            if speaking:
+                period = tone_period(rng.choice((180, 220, 330, 440)), sample_rate, channels)
+                burst = period * (frame_count * frame_bytes // len(period) + 1)
+                wav_file.writeframes(burst[:frame_count * frame_bytes])
+            else:
+                wav_file.writeframes(bytes(frame_count * frame_bytes))
+            remaining_frames -= frame_count
+            speaking = not speaking
+
+# Function to generate a corpus of count recordings in corpus_folder/<day folder>, returns the seconds of audio written
+def generate_corpus(corpus_folder, day_folder, count, duration_s, sample_rate, channels, seed):
+    rng = random.Random(seed)
+    day_folder_path = os.path.join(corpus_folder, day_folder)
+    os.makedirs(day_folder_path, exist_ok=True)
+    for index in range(count):
+        write_synthetic_wav(os.path.join(day_folder_path, f"bench_{index:05d}.wav"), duration_s, sample_rate, channels, rng)
+    return count * duration_s
+
+
+# SSH server accepting any password, with sessions for the SFTP subsystem and for the sha256sum run by remote_checksum
+class BenchmarkSSHServer(paramiko.ServerInterface):
+    def __init__(self, root):
+        self.root = root
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_sha256sum, args=(channel, command.decode(errors='replace'), self.root), daemon=True).start()
+        return True
+
+# Function to answer an exec request like the server's sha256sum, the only command the manager runs remotely
+def run_sha256sum(channel, command, root):
+    try:
+        arguments = shlex.split(command)
+        file_path = os.path.realpath(arguments[1]) if len(arguments) == 2 and arguments[0] == 'sha256sum' else None
+        if file_path is None or not file_path.startswith(root + os.sep):
+            channel.send_exit_status(1)
+            return
+        checksum = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for data in iter(lambda: file.read(1024 * 1024), b''):
+                checksum.update(data)
+        channel.sendall(f"{checksum.hexdigest()}  {arguments[1]}\n".encode())
+        channel.send_exit_status(0)
+    except Exception:
+        channel.send_exit_status(1)
+    finally:
+        channel.close()
+
+# Read-only SFTP file handle that can report its size, which prefetching asks for
+class BenchmarkSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+# Read-only SFTP view of the local corpus folder. Remote paths are the local paths, so remote_path can point at it.
+class BenchmarkSFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.root
+
+    def local_path(self, path):
+        local_path = os.path.realpath(path)
+        if local_path != self.root and not local_path.startswith(self.root + os.sep):
+            raise PermissionError(f"{path} is outside the corpus")
+        return local_path
+
+    def list_folder(self, path):
+        try:
+            folder = self.local_path(path)
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(folder, name)), name) for name in os.listdir(folder)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            handle = BenchmarkSFTPHandle(flags)
+            handle.readfile = open(self.local_path(path), 'rb')
+            return handle
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+# Function to serve the corpus folder over SFTP on a free local port, returns (port, function that stops the server)
+def start_sftp_server(corpus_folder):
+    root = os.path.realpath(corpus_folder)
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+    transports = []
+
+    def accept_connections():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                # The listener was closed
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, BenchmarkSFTPServer)
+            transports.append(transport)
+            threading.Thread(target=transport.start_server, kwargs={'server': BenchmarkSSHServer(root)}, daemon=True).start()
+
+    threading.Thread(target=accept_connections, name="benchmark-sftp", daemon=True).start()
+
+    def stop():
+        listener.close()
+        for transport in transports:
+            transport.close()
+    return listener.getsockname()[1], stop
+
+
+# SMTP session that accepts any login and message, counting what it receives
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 benchmark SMTP sink")
+        for line in self.rfile:
+            verb = line.decode(errors='replace').strip().split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.reply("250-benchmark")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == 'AUTH':
+                self.reply("235 Authentication successful")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                message_bytes = 0
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    message_bytes += len(data_line)
+                self.server.message_sizes.append(message_bytes)
+                self.reply("250 Message accepted")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+# Function to start the SMTP sink on a free local port, returns the server (message_sizes lists what it received)
+def start_smtp_sink():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SmtpSinkHandler)
+    server.daemon_threads = True
+    server.message_sizes = []
+    threading.Thread(target=server.serve_forever, name="benchmark-smtp", daemon=True).start()
+    return server
+
+
+# Function to read the peak resident memory of this process and of its finished children (conversion workers
+# and ffmpeg) in MiB. The peaks cover the run so far, so a stage's figure includes the stages before it.
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / (1024 * 1024), 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / (1024 * 1024), 1))
+
+# Function to run one stage and time it, returns its metrics
+def measure_stage(stage_name, run_stage, file_count, audio_seconds):
+    logging.info(f"Benchmark stage {stage_name} started.")
+    start_time = time.perf_counter()
+    run_stage()
+    elapsed = time.perf_counter() - start_time
+    peak_rss, peak_children_rss = peak_rss_mb()
+    metrics = {'stage': stage_name, 'seconds': round(elapsed, 3),
+               'files_per_second': round(file_count / elapsed, 2) if elapsed > 0 else None,
+               'audio_seconds_per_second': round(audio_seconds / elapsed, 1) if elapsed > 0 else None,
+               'peak_rss_mb': peak_rss, 'peak_children_rss_mb': peak_children_rss}
+    print(f"{stage_name:<10} {elapsed:9.2f}s {metrics['files_per_second'] or 0:10.2f} files/s "
+          f"{metrics['audio_seconds_per_second'] or 0:10.1f} audio-s/s  peak RSS {peak_rss} MiB (children {peak_children_rss} MiB)")
+    return metrics
+
+# Function to point the manager at the local SFTP server and SMTP sink, through the same settings production uses
+def use_local_servers(sftp_port, smtp_port, corpus_folder):
+    def encode(value):
+        return base64.b64encode(str(value).encode()).decode()
+    os.environ.update({'SSH_HOST': encode('127.0.0.1'), 'SSH_PORT': encode(sftp_port), 'SSH_USERNAME': encode('benchmark'),
+                       'SSH_PASSWORD': encode('benchmark'), 'SENDER_EMAIL': encode('benchmark@localhost'),
+                       'SENDER_PASSWORD': encode('benchmark'), 'RECIEVER_EMAIL': encode('receiver@localhost'), 'CC_EMAIL': encode('')})
+    config.remote_path = os.path.realpath(corpus_folder)
+    config.smtp_host, config.smtp_port, config.smtp_ssl = '127.0.0.1', smtp_port, False
+
+# Function to run the benchmark in work_folder, returns the results to save
+def run_benchmark(args, work_folder):
+    from .cli import download_days, convert_input
+    from .database import create_database, close_connections, get_connection
+
+    corpus_folder = os.path.join(work_folder, 'remote')
+    day_folder = datetime.now().strftime("%y%m%d")
+    start_time = time.perf_counter()
+    audio_seconds = generate_corpus(corpus_folder, day_folder, args.files, args.seconds, args.sample_rate, args.channels, args.seed)
+    print(f"Generated {args.files} file(s), {audio_seconds:.0f}s of audio, in {time.perf_counter() - start_time:.2f}s.")
+
+    sftp_port, stop_sftp_server = start_sftp_server(corpus_folder)
+    smtp_sink = start_smtp_sink()
+    os.chdir(work_folder)
+    try:
+        use_local_servers(sftp_port, smtp_sink.server_address[1], corpus_folder)
+        config.setup()
+        create_database(config.database_name)
+
+        from .report import create_source_file_report
+        from .notify import send_status_email
+        stages = []
+        if args.pipeline:
+            from .sync import remote_session
+            from .pipeline import run_pipeline
+            def pipeline_stage():
+                with remote_session() as (sftp, sftp_pool):
+                    run_pipeline(sftp, config.remote_path, config.input_folder, config.processing_folder, config.completed_folder,
+                                 config.failed_folder, config.database_name, sftp_pool)
+            stages.append(measure_stage('pipeline', pipeline_stage, args.files, audio_seconds))
+        else:
+            stages.append(measure_stage('download', download_days, args.files, audio_seconds))
+            # Chunks are cut in the same pass as the conversion, so this stage covers both
+            stages.append(measure_stage('convert', convert_input, args.files, audio_seconds))
+        stages.append(measure_stage('report', lambda: create_source_file_report(config.database_name, config.report_folder),
+                                    args.files, audio_seconds))
+        stages.append(measure_stage('notify', lambda: send_status_email(config.database_name), args.files, audio_seconds))
+
+        conn = get_connection(config.database_name)
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM SourceFile GROUP BY status").fetchall())
+        chunk_count = conn.execute("SELECT COUNT(*) FROM ProcessedFiles WHERE chunk_start_ms IS NOT NULL").fetchone()[0]
+        close_connections()
+    finally:
+        stop_sftp_server()
+        smtp_sink.shutdown()
+
+    print(f"SourceFile statuses: {counts}, {chunk_count} chunk(s), {len(smtp_sink.message_sizes)} email(s) captured.")
+    return {'started': datetime.now().isoformat(timespec='seconds'),
+            'corpus': {'files': args.files, 'seconds_per_file': args.seconds, 'sample_rate': args.sample_rate,
+                       'channels': args.channels, 'seed': args.seed},
+            'settings': {'pipeline': args.pipeline, 'download_workers': config.download_workers, 'sftp_pool_size': config.sftp_pool_size,
+                         'conversion_workers': config.conversion_workers, 'chunking_engine': config.chunking_engine,
+                         'decode_mode': config.decode_mode, 'encoding_profiles': config.encoding_profiles,
+                         'conversion_cache': config.conversion_cache_enabled},
+            'statuses': counts, 'chunks': chunk_count, 'emails': len(smtp_sink.message_sizes), 'stages': stages}
+
+# Function to print how much faster or slower every stage ran than in a saved run
+def compare_with_baseline(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline_stages = {stage['stage']: stage for stage in json.load(baseline_file)['stages']}
+    print(f"Compared with {baseline_path}:")
+    for stage in results['stages']:
+        baseline_stage = baseline_stages.get(stage['stage'])
+        if baseline_stage and stage['seconds'] > 0:
+            print(f"{stage['stage']:<10} {baseline_stage['seconds']:9.2f}s -> {stage['seconds']:9.2f}s ({baseline_stage['seconds'] / stage['seconds']:.2f}x)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="wav_file_manager.benchmark", description="Time the daily job against a local SFTP server and SMTP sink.")
+    parser.add_argument("--files", type=int, default=20, help="recordings in the corpus (default: %(default)s)")
+    parser.add_argument("--seconds", type=float, default=60, help="length of each recording in seconds (default: %(default)s)")
+    parser.add_argument("--sample-rate", type=int, default=16000, help="sample rate of the recordings (default: %(default)s)")
+    parser.add_argument("--channels", type=int, default=1, help="channels of the recordings (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic audio (default: %(default)s)")
+    parser.add_argument("--pipeline", action="store_true", help="time download and conversion as one pipelined stage")
+    parser.add_argument("--output", help="file to save the results to (default: benchmark-<timestamp>.json)")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the work folder with the corpus, database and outputs")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    output_path = os.path.abspath(args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    original_folder = os.getcwd()
+    work_folder = tempfile.mkdtemp(prefix="wav_file_manager_benchmark_")
+    try:
+        results = run_benchmark(args, work_folder)
+    finally:
+        os.chdir(original_folder)
+        if args.keep:
+            print(f"Work folder kept at {work_folder}")
+        else:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results saved to {output_path}")
+    if baseline_path:
+        compare_with_baseline(results, baseline_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+from datetime import datetime
+
+from . import config
+from .database import get_connection, database_lock
+
+
+# Function to compute the SHA-256 of a local file
+def hash_file(file_path):
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for data in iter(lambda: file.read(1024 * 1024), b''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+# Function to build the conversion cache key of an encoding profile from the audio content hash and the encoding parameters
+def conversion_cache_key(content_hash, profile):
+    profile_name, audio_format, bitrate, channels, sample_rate = profile
+    encoding = bitrate
+    if (audio_format, channels, sample_rate) != ('mp3', None, None):
+        encoding = f"{audio_format}-{bitrate}-{channels or 'src'}ch-{sample_rate or 'src'}hz"
+    if config.chunking_engine == 'silence':
+        drop = 'drop' if config.drop_silent_chunks else 'keep'
+        return (f"{content_hash}_{encoding}_silence-{config.silence_min_chunk_ms}-{config.silence_max_chunk_ms}"
+                f"-{config.silence_threshold_db:g}-{config.silence_frame_ms}-{drop}")
+    return f"{content_hash}_{encoding}_{config.chunk_length_ms}"
+
+# Function to hard link a file, copying it when linking is not possible (e.g. across filesystems)
+def link_or_copy(source_path, destination_path):
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copy2(source_path, destination_path)
+
+# Function to put the converted file and chunks of a recording into the cache. Chunks are stored without the
+# recording's name so a hit under another name can restore them, and their positions are listed in
+# boundaries.tsv. Returns (size in bytes, chunk count).
+def store_in_cache(cache_key, converted_file_path, chunk_files, filename_without_extension):
+    cache_entry_folder = os.path.join(config.cache_folder, cache_key)
+    if os.path.isdir(cache_entry_folder):
+        return None
+    # Fill a temporary folder and rename it, so workers never see a half-written entry
+    temporary_folder = f"{cache_entry_folder}.{os.getpid()}.tmp"
+    os.makedirs(os.path.join(temporary_folder, "chunks"), exist_ok=True)
+    converted_extension = os.path.splitext(converted_file_path)[1]
+    link_or_copy(converted_file_path, os.path.join(temporary_folder, f"converted{converted_extension}"))
+    with open(os.path.join(temporary_folder, "boundaries.tsv"), 'w') as boundaries_file:
+        for chunk_file_path, chunk_file_name, chunk_start_ms, chunk_end_ms in chunk_files:
+            chunk_suffix = chunk_file_name[len(filename_without_extension) + 1:]
+            link_or_copy(chunk_file_path, os.path.join(temporary_folder, "chunks", chunk_suffix))
+            boundaries_file.write(f"{chunk_suffix}\t{chunk_start_ms}\t{chunk_end_ms}\n")
+    try:
+        os.rename(temporary_folder, cache_entry_folder)
+    except OSError:
+        # Another worker stored the same audio first
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        return None
+    size_bytes = os.path.getsize(converted_file_path) + sum(os.path.getsize(chunk_file[0]) for chunk_file in chunk_files)
+    return size_bytes, len(chunk_files)
+
+# Function to read the chunk positions of a cache entry, {chunk suffix: (start ms, end ms)}.
+# Entries stored before positions were recorded have none.
+def load_cached_boundaries(cache_entry_folder):
+    boundaries_file_path = os.path.join(cache_entry_folder, "boundaries.tsv")
+    if not os.path.exists(boundaries_file_path):
+        return {}
+    boundaries = {}
+    with open(boundaries_file_path) as boundaries_file:
+        for line in boundaries_file:
+            chunk_suffix, chunk_start_ms, chunk_end_ms = line.rstrip('\n').split('\t')
+            boundaries[chunk_suffix] = (int(chunk_start_ms), int(chunk_end_ms))
+    return boundaries
+
+# Function to link the cached converted file and chunks of a recording into its folders, returns the chunk files or None if the entry is gone
+def restore_from_cache(cache_key, converted_file_path, chunks_folder, filename_without_extension):
+    cache_entry_folder = os.path.join(config.cache_folder, cache_key)
+    try:
+        converted_extension = os.path.splitext(converted_file_path)[1]
+        link_or_copy(os.path.join(cache_entry_folder, f"converted{converted_extension}"), converted_file_path)
+        boundaries = load_cached_boundaries(cache_entry_folder)
+        chunk_files = []
+        for chunk_suffix in sorted(os.listdir(os.path.join(cache_entry_folder, "chunks"))):
+            chunk_file_name = f"{filename_without_extension}_{chunk_suffix}"
+            chunk_file_path = os.path.join(chunks_folder, chunk_file_name)
+            link_or_copy(os.path.join(cache_entry_folder, "chunks", chunk_suffix), chunk_file_path)
+            chunk_files.append((chunk_file_path, chunk_file_name) + boundaries.get(chunk_suffix, (None, None)))
+        return chunk_files
+    except OSError as e:
+        logging.warning(f"Error restoring cache entry {cache_key}: {e}")
+        return None
+
+# Function to record a cache hit or a new cache entry in the cache index
+def record_cache_entry(conn, cache_entry):
+    cache_key, hit, size_bytes, chunk_count, bitrate = cache_entry
+    if hit:
+        conn.execute("UPDATE ConversionCache SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+    else:
+        content_hash = cache_key.split('_', 1)[0]
+        conn.execute("INSERT OR REPLACE INTO ConversionCache (cache_key, content_hash, bitrate, chunk_length_ms, size_bytes, chunk_count, created_date, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (cache_key, content_hash, bitrate, config.chunk_length_ms, size_bytes, chunk_count, datetime.now().strftime("%y-%m-%d"), time.time()))
+
+# Function to evict the least recently used cache entries until the cache fits in cache_max_bytes
+def evict_conversion_cache(database_name):
+    conn = get_connection(database_name)
+    with database_lock, conn:
+        entries = conn.execute("SELECT cache_key, size_bytes FROM ConversionCache ORDER BY last_used DESC").fetchall()
+        total_bytes = 0
+        evicted_keys = []
+        for cache_key, size_bytes in entries:
+            total_bytes += size_bytes or 0
+            if total_bytes > config.cache_max_bytes:
+                shutil.rmtree(os.path.join(config.cache_folder, cache_key), ignore_errors=True)
+                evicted_keys.append((cache_key,))
+        conn.executemany("DELETE FROM ConversionCache WHERE cache_key = ?", evicted_keys)
+    if evicted_keys:
+        logging.info(f"Evicted {len(evicted_keys)} entries from the conversion cache.")
+
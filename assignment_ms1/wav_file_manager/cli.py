@@ -0,0 +1,241 @@
+import time
+import logging
+import argparse
+from datetime import datetime, date
+
+from . import config
+from .database import create_database, close_connections, count_files_by_status, print_database
+from .metrics import span, start_run, finish_run
+
+
+# Every command imports the stage modules it runs inside its function, so a command only pays for the
+# libraries it uses (paramiko for sync, pydub for convert, pandas for report) and importing this module
+# has no side effects.
+
+# Function to download today's folder, or the day folders named in folder_dates, from the remote server.
+# Returns the number of files downloaded.
+def download_days(folder_dates=None):
+    from .sync import remote_session, download_folders_from_remote
+    with span('sync'), remote_session() as (sftp, sftp_pool):
+        return download_folders_from_remote(sftp, config.remote_path, config.input_folder, config.database_name, sftp_pool, folder_dates=folder_dates)
+
+# Function to name the day folders to download for the --from and --to options, None for just today's
+def requested_days(args):
+    if args.start_date is None:
+        return None
+    from .sync import day_folder_names
+    return day_folder_names(args.start_date, args.end_date or date.today())
+
+# Function to parse a YYYY-MM-DD command line date
+def parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{value}', expected YYYY-MM-DD")
+
+# Function to convert the files waiting in the input folder and clean up the emptied folders
+def convert_input():
+    from .convert import convert_wav_to_mp3, delete_empty_main_folders
+    with span('convert'):
+        convert_wav_to_mp3(config.input_folder, config.processing_folder, config.completed_folder, config.failed_folder, config.database_name)
+
+    # Delete main empty folders in the input directory
+    delete_empty_main_folders(config.input_folder)
+    # Recordings were promoted to completed as they finished, only their emptied main folders are left in processing
+    delete_empty_main_folders(config.processing_folder)
+    logging.info("Empty folders removed from the processing folder.")
+
+def sync_command(args):
+    downloaded_count = download_days(requested_days(args))
+    print(f"Downloaded {downloaded_count or 0} file(s).")
+
+def convert_command(args):
+    convert_input()
+
+# Function to render the SourceFile report partitions that changed, returns today's report file
+def create_report():
+    from .report import create_source_file_report
+    with span('report'):
+        return create_source_file_report(config.database_name, config.report_folder)
+
+# Function to send the daily status email, attaching today's report
+def send_notification(attachment_path=None):
+    from .notify import send_status_email
+    with span('notify'):
+        send_status_email(config.database_name, attachment_path)
+
+def report_command(args):
+    create_report()
+
+def notify_command(args):
+    send_notification()
+
+def watch_command(args):
+    from .watch import watch
+    watch(args.interval)
+
+# Function to apply the retention policies to the completed recordings
+def apply_retention_policies(dry_run=False):
+    from .retention import apply_retention
+    with span('retention'):
+        return apply_retention(config.database_name, config.completed_folder, config.deleted_folder, dry_run)
+
+def prune_command(args):
+    if not config.retention_policies:
+        print("No retention policies set, nothing to prune.")
+        return
+    deleted_count, archived_count, purged_count, reclaimed_bytes = apply_retention_policies(args.dry_run)
+    if args.dry_run:
+        print(f"Would delete {deleted_count} and archive {archived_count} folder(s).")
+    else:
+        print(f"Deleted {deleted_count}, archived {archived_count} and purged {purged_count} folder(s), {reclaimed_bytes} bytes reclaimed.")
+
+def status_command(args):
+    counts = count_files_by_status(config.database_name)
+    for status, count in sorted(counts.items(), key=lambda item: str(item[0])):
+        print(f"{status}: {count}")
+    print(f"Total: {sum(counts.values())}")
+    from .jobs import count_jobs_by_state
+    job_counts = count_jobs_by_state(config.database_name)
+    if job_counts:
+        print("Conversion jobs: " + ", ".join(f"{state} {count}" for state, count in sorted(job_counts.items())))
+
+# Function to print the stage timings of the latest finished run, or of the run named with --run
+def metrics_command(args):
+    from .metrics import latest_run, summarize_stages, format_stage_summary, write_prometheus_textfile
+    run_id = args.run
+    if run_id is None:
+        run = latest_run(config.database_name)
+        if run is None:
+            print("No runs recorded yet.")
+            return
+        run_id = run[0]
+        print(f"Run {run_id} ({run[1]}) started {datetime.fromtimestamp(run[2]).strftime('%Y-%m-%d %H:%M:%S')}")
+    stage_lines = format_stage_summary(summarize_stages(config.database_name, run_id))
+    if not stage_lines:
+        print(f"No metrics recorded for run {run_id}.")
+        return
+    for line in stage_lines:
+        print(line)
+    if args.textfile:
+        write_prometheus_textfile(config.database_name, args.textfile, run_id)
+        print(f"Metrics written to {args.textfile}.")
+
+# The whole daily job: download, convert, report and email
+def run_command(args):
+    if config.pipeline_mode:
+        # Every file is converted as soon as it is downloaded
+        from .sync import remote_session
+        from .pipeline import run_pipeline
+        with span('pipeline'), remote_session() as (sftp, sftp_pool):
+            downloaded_count = run_pipeline(sftp, config.remote_path, config.input_folder, config.processing_folder, config.completed_folder,
+                                            config.failed_folder, config.database_name, sftp_pool, folder_dates=requested_days(args))
+    else:
+        downloaded_count = download_days(requested_days(args))
+
+    if downloaded_count == 0:
+        logging.error("All files have been downloaded today! Exiting...")
+        print("All files have been downloaded today! Exiting...")
+        return
+
+    # View the SourceFile table after downloading files
+    print_database(config.database_name, "SourceFile")
+
+    if not config.pipeline_mode:
+        # Convert wav files to mp3 and create chunks
+        convert_input()
+
+    # View the ProcessedFiles table after processing is complete
+    print_database(config.database_name, "ProcessedFiles")
+
+    # Delete and archive the artifacts that expired, before the report reads their statuses
+    if config.retention_policies:
+        apply_retention_policies()
+
+    # Create the SourceFile report partitions that changed, today's is attached
+    attachment_path = create_report()
+    send_notification(attachment_path)
+
+# Function to add the options that backfill a range of day folders instead of today's
+def add_date_range_options(parser):
+    parser.add_argument("--from", dest="start_date", type=parse_date, metavar="YYYY-MM-DD", help="backfill the day folders from this date")
+    parser.add_argument("--to", dest="end_date", type=parse_date, metavar="YYYY-MM-DD", help="last day folder to backfill (default: today)")
+
+# Function to build the command line parser
+def build_parser():
+    parser = argparse.ArgumentParser(prog="wav_file_manager", description="Download, convert and report on WAV recordings.")
+    parser.add_argument("--database", default=config.database_name, help="SQLite database file (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = subparsers.add_parser("sync", help="download today's new or changed WAV files")
+    sync_parser.add_argument("--workers", type=int, help="parallel downloads and folder scans (default: DOWNLOAD_WORKERS)")
+    add_date_range_options(sync_parser)
+    sync_parser.set_defaults(handler=sync_command)
+
+    convert_parser = subparsers.add_parser("convert", help="convert the WAV files in the input folder to mp3 and chunks")
+    convert_parser.add_argument("--workers", type=int, help="conversion processes (default: CONVERSION_WORKERS)")
+    convert_parser.set_defaults(handler=convert_command)
+
+    report_parser = subparsers.add_parser("report", help="render the SourceFile report for the days that changed")
+    report_parser.add_argument("--format", choices=["csv", "parquet", "xlsx"], help="report format (default: REPORT_FORMAT)")
+    report_parser.set_defaults(handler=report_command)
+
+    watch_parser = subparsers.add_parser("watch", help="keep polling today's remote folder and convert new files as they arrive")
+    watch_parser.add_argument("--interval", type=float, help="seconds between polls (default: WATCH_INTERVAL)")
+    watch_parser.set_defaults(handler=watch_command)
+
+    subparsers.add_parser("notify", help="email the daily status report").set_defaults(handler=notify_command)
+    subparsers.add_parser("status", help="print the number of files per status").set_defaults(handler=status_command)
+
+    prune_parser = subparsers.add_parser("prune", help="delete and archive the completed files past their retention policy")
+    prune_parser.add_argument("--dry-run", action="store_true", help="only count the folders that would be deleted or archived")
+    prune_parser.set_defaults(handler=prune_command)
+
+    metrics_parser = subparsers.add_parser("metrics", help="print how long each stage of the latest sync, convert, watch or run took")
+    metrics_parser.add_argument("--run", help="run id to print instead of the latest run's")
+    metrics_parser.add_argument("--textfile", help="also write the run's stage totals to this file in the Prometheus text format")
+    metrics_parser.set_defaults(handler=metrics_command)
+
+    run_parser = subparsers.add_parser("run", help="run the whole daily job: sync, convert, report and notify")
+    run_parser.add_argument("--pipeline", action="store_true", help="convert each file as soon as it is downloaded")
+    add_date_range_options(run_parser)
+    run_parser.set_defaults(handler=run_command)
+    return parser
+
+# Function to apply the command line options on top of the settings read from the environment
+def apply_options(args):
+    config.database_name = args.database
+    if getattr(args, "workers", None):
+        if args.command == "sync":
+            config.download_workers = config.sftp_pool_size = args.workers
+        else:
+            config.conversion_workers = args.workers
+    if getattr(args, "format", None):
+        config.report_format = args.format
+    if getattr(args, "pipeline", False):
+        config.pipeline_mode = True
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, "end_date", None) and (args.start_date is None or args.end_date < args.start_date):
+        parser.error("--to needs a --from date on or before it")
+    if getattr(args, "start_date", None) and args.end_date is None and args.start_date > date.today():
+        parser.error("--from cannot be after today")
+    apply_options(args)
+    config.setup()
+
+    start_time = time.monotonic()
+    # Every command but metrics, which reads them, and status records its stage timings as a run
+    if args.command not in ("metrics", "status"):
+        start_run(args.command)
+    try:
+        # Create the database and tables if they don't exist
+        create_database(config.database_name)
+        args.handler(args)
+    finally:
+        # Write the run's timings, then close the database connection, checkpointing the write-ahead log
+        finish_run(config.database_name)
+        close_connections()
+    logging.info(f"Command '{args.command}' finished in {time.monotonic() - start_time:.2f}s.")
+    return 0
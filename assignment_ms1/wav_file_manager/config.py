@@ -0,0 +1,187 @@
+import os
+import base64
+import logging
+
+
+# Working folders, relative to the directory the manager is run from
+input_folder = 'input'
+processing_folder = 'processing'
+completed_folder = 'completed'
+failed_folder = 'failed'
+deleted_folder = 'deleted'
+report_folder = 'reports'
+log_folder = 'logs'
+cache_folder = 'cache'
+directories = [input_folder, processing_folder, completed_folder, failed_folder, deleted_folder, report_folder, log_folder, cache_folder]
+
+# Database and log file. The database uses a write-ahead log, which only works for processes on one host;
+# set DATABASE_JOURNAL_MODE to DELETE for a database that several hosts share over network storage.
+database_name = 'wav_file_manager.db'
+database_journal_mode = os.environ.get('DATABASE_JOURNAL_MODE', 'WAL').upper()
+if database_journal_mode not in ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST'):
+    raise ValueError(f"invalid database journal mode '{database_journal_mode}'")
+log_file_path = os.path.join(log_folder, 'converter.log')
+
+# Remote folder holding one sub folder of WAV files per day
+remote_path = "/home/trellissoft/temp_files/"
+
+# Download settings: worker threads, pooled SFTP sessions, SSH transports to spread them over,
+# and the file size from which reads are pipelined with prefetch
+download_workers = int(os.environ.get('DOWNLOAD_WORKERS', '4'))
+sftp_pool_size = int(os.environ.get('SFTP_POOL_SIZE', str(download_workers)))
+ssh_transport_count = int(os.environ.get('SSH_TRANSPORTS', '1'))
+prefetch_threshold = int(os.environ.get('PREFETCH_THRESHOLD', str(8 * 1024 * 1024)))
+transfer_block_size = 32768
+
+# Transfer settings: attempts per file (each resuming from the part-file), whether to verify against a remote checksum
+# and how long to wait for it. The remote size and mtime a part-file was started from are kept in <part-file>.source.
+transfer_attempts = int(os.environ.get('TRANSFER_ATTEMPTS', '3'))
+verify_remote_checksum = os.environ.get('VERIFY_REMOTE_CHECKSUM', '1') == '1'
+remote_checksum_timeout = float(os.environ.get('REMOTE_CHECKSUM_TIMEOUT', '60'))
+part_file_suffix = '.part'
+part_source_suffix = '.source'
+
+# Watch settings: seconds between polls of today's folder, between SSH keepalives (0 disables them)
+# and the longest wait between reconnect attempts. A file is only downloaded once it is listed unchanged
+# at two polls in a row or was last modified upload_settle_seconds ago, so uploads in progress are left alone.
+watch_interval = float(os.environ.get('WATCH_INTERVAL', '5'))
+upload_settle_seconds = float(os.environ.get('UPLOAD_SETTLE_SECONDS', '30'))
+ssh_keepalive_interval = int(os.environ.get('SSH_KEEPALIVE', '30'))
+reconnect_max_delay = float(os.environ.get('RECONNECT_MAX_DELAY', '60'))
+
+# Conversion settings: number of worker processes (1 converts in this process), chunk length and chunking engine
+# ('segment' cuts the encoded mp3 in one ffmpeg run, 'export' encodes every chunk separately,
+# 'silence' cuts the encoded mp3 at silences instead of every chunk_length_ms)
+conversion_workers = int(os.environ.get('CONVERSION_WORKERS', str(os.cpu_count() or 1)))
+chunk_length_ms = int(os.environ.get('CHUNK_LENGTH_MS', '10000'))
+chunking_engine = os.environ.get('CHUNKING_ENGINE', 'segment')
+mp3_bitrate = os.environ.get('MP3_BITRATE', '128k')
+
+# ffmpeg encoders of the formats an encoding profile can write, the format name doubling as muxer and file extension
+audio_encoders = {'mp3': 'libmp3lame', 'opus': 'libopus'}
+
+# Function to parse encoding profiles written as name=format:bitrate[:channels[:sample rate]] separated by commas,
+# e.g. 'archive=mp3:128k,transcribe=opus:24k:1:16000', into (name, format, bitrate, channels, sample rate) tuples.
+# Channels and sample rate are None to keep the recording's own. Without profiles there is one unnamed mp3 profile.
+def parse_encoding_profiles(value):
+    profiles = []
+    for profile_spec in filter(None, (part.strip() for part in value.split(','))):
+        profile_name, _, settings = profile_spec.partition('=')
+        audio_format, _, bitrate = settings.partition(':')
+        bitrate, *options = bitrate.split(':')
+        if not profile_name or audio_format not in audio_encoders or not bitrate or len(options) > 2:
+            raise ValueError(f"invalid encoding profile '{profile_spec}'")
+        if profile_name in [profile[0] for profile in profiles]:
+            raise ValueError(f"duplicate encoding profile name '{profile_name}'")
+        try:
+            channels = int(options[0]) if len(options) > 0 and options[0] else None
+            sample_rate = int(options[1]) if len(options) > 1 and options[1] else None
+        except ValueError:
+            raise ValueError(f"invalid encoding profile '{profile_spec}'")
+        profiles.append((profile_name, audio_format, bitrate, channels, sample_rate))
+    return profiles or [(None, 'mp3', mp3_bitrate, None, None)]
+
+# Encoding profiles: every recording is decoded once and encoded by all profiles in parallel, each writing
+# converted/<profile>/ and chunks/<profile>/ (the unnamed default profile writes converted/ and chunks/)
+encoding_profiles = parse_encoding_profiles(os.environ.get('ENCODING_PROFILES', ''))
+
+# Silence chunking settings: chunk length window, level below which audio counts as silence, length of the
+# analysis frames and whether chunks without any sound are left out
+silence_min_chunk_ms = int(os.environ.get('SILENCE_MIN_CHUNK_MS', '5000'))
+silence_max_chunk_ms = int(os.environ.get('SILENCE_MAX_CHUNK_MS', '15000'))
+silence_threshold_db = float(os.environ.get('SILENCE_THRESHOLD_DB', '-40'))
+silence_frame_ms = int(os.environ.get('SILENCE_FRAME_MS', '20'))
+drop_silent_chunks = os.environ.get('DROP_SILENT_CHUNKS', '0') == '1'
+
+# Conversion cache settings: converted audio is kept under cache_folder by content hash and encoding
+# parameters, and the least recently used entries are evicted beyond cache_max_bytes
+conversion_cache_enabled = os.environ.get('CONVERSION_CACHE', '1') == '1'
+cache_max_bytes = int(os.environ.get('CACHE_MAX_BYTES', str(10 * 1024 * 1024 * 1024)))
+
+# Job settings: seconds a claimed conversion job stays leased without a heartbeat, seconds between heartbeats
+# and claims per job before it is marked failed
+job_lease_seconds = float(os.environ.get('JOB_LEASE_SECONDS', '300'))
+job_heartbeat_interval = float(os.environ.get('JOB_HEARTBEAT_SECONDS', str(job_lease_seconds / 3)))
+job_max_attempts = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+
+# Pipeline settings: convert each file as soon as it is downloaded, with at most pipeline_queue_size files waiting
+pipeline_mode = os.environ.get('PIPELINE_MODE', '0') == '1'
+pipeline_queue_size = int(os.environ.get('PIPELINE_QUEUE_SIZE', '8'))
+# Seconds the pipeline waits on the download queue before checking the running conversions again
+pipeline_poll_seconds = 0.5
+
+# Decode settings: 'stream' feeds the encoder from the wav file in buffers of stream_buffer_bytes,
+# 'memory' loads the whole file with pydub (also used for wav files that are not integer PCM)
+decode_mode = os.environ.get('DECODE_MODE', 'stream')
+stream_buffer_bytes = int(os.environ.get('STREAM_BUFFER_BYTES', str(1024 * 1024)))
+
+# Validation settings: wav files shorter than wav_min_duration_ms or longer than wav_max_duration_ms (0 for no limit)
+# are moved to the failed folder before they are decoded
+wav_min_duration_ms = int(os.environ.get('WAV_MIN_DURATION_MS', '1'))
+wav_max_duration_ms = int(os.environ.get('WAV_MAX_DURATION_MS', '0'))
+
+# Raw PCM formats for ffmpeg by sample width in bytes
+pcm_formats = {1: 'u8', 2: 's16le', 3: 's24le', 4: 's32le'}
+
+# Function to read the retention policy of every artifact of a completed recording ('original', 'converted' or 'chunks')
+# from RETENTION_<ARTIFACT>, written as 'delete:<days>' or 'archive:<days>'. Returns {artifact: (action, days)};
+# artifacts without a policy are kept.
+def parse_retention_policies():
+    policies = {}
+    for artifact in ('original', 'converted', 'chunks'):
+        policy = os.environ.get(f'RETENTION_{artifact.upper()}', '')
+        if not policy:
+            continue
+        action, _, days = policy.partition(':')
+        if action not in ('delete', 'archive') or not days.isdigit():
+            raise ValueError(f"invalid retention policy '{policy}' for {artifact}")
+        policies[artifact] = (action, int(days))
+    return policies
+
+# Retention settings: an artifact whose rows are older than its policy's days is moved to deleted_folder ('delete')
+# or packed into one archive in the recording folder ('archive'). Deleted artifacts are purged after
+# retention_grace_days, and recordings are handled retention_batch_size at a time, one transaction per batch.
+retention_policies = parse_retention_policies()
+retention_grace_days = int(os.environ.get('RETENTION_GRACE_DAYS', '7'))
+retention_batch_size = int(os.environ.get('RETENTION_BATCH_SIZE', '500'))
+# Compression of the archives: 'gz', 'bz2', 'xz' or '' for a plain tar
+archive_compression = os.environ.get('ARCHIVE_COMPRESSION', 'gz')
+
+# Mail settings: SMTP server the status email is sent through, over SSL unless smtp_ssl is off
+smtp_host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+smtp_port = int(os.environ.get('SMTP_PORT', '465'))
+smtp_ssl = os.environ.get('SMTP_SSL', '1') == '1'
+
+# Metrics settings: file the stage totals of every run are written to in the Prometheus text format,
+# e.g. for node_exporter's textfile collector ('' writes none)
+metrics_textfile = os.environ.get('METRICS_TEXTFILE', '')
+
+# Report settings: output format of the SourceFile report partitions ('csv', 'parquet' or 'xlsx')
+report_format = os.environ.get('REPORT_FORMAT', 'csv')
+
+
+def base64_decode(encoded_variable):
+    decoded_variable = base64.b64decode(encoded_variable.encode()).decode()
+    return decoded_variable
+
+# Function to read the SSH credentials and server details from the environment
+def ssh_credentials():
+    hostname = base64_decode(os.environ.get('SSH_HOST'))
+    username = base64_decode(os.environ.get('SSH_USERNAME'))
+    password = base64_decode(os.environ.get('SSH_PASSWORD'))
+    port = int(base64_decode(os.environ.get('SSH_PORT', '22')))
+    return hostname, port, username, password
+
+# Function to read the email details from the environment
+def email_settings():
+    sender_email = base64_decode(os.environ.get('SENDER_EMAIL'))
+    sender_password = base64_decode(os.environ.get('SENDER_PASSWORD'))
+    receiver_email = base64_decode(os.environ.get('RECIEVER_EMAIL'))
+    cc_email = base64_decode(os.environ.get('CC_EMAIL'))
+    return sender_email, sender_password, receiver_email, cc_email
+
+# Function to create the working folders if they don't exist and set up logging
+def setup():
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    logging.basicConfig(filename=log_file_path, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
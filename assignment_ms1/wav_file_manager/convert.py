@@ -0,0 +1,577 @@
+import os
+import glob
+import shutil
+import logging
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pydub import AudioSegment
+
+from . import config
+from .database import get_connection, database_lock
+from .jobs import worker_identity, enqueue_jobs, claim_jobs, start_heartbeat, finish_job
+from .validate import read_wav_header, is_streamable
+from .metrics import span, count, current_span, take_spans, record_spans
+from .cache import hash_file, conversion_cache_key, store_in_cache, restore_from_cache, record_cache_entry, evict_conversion_cache
+
+
+# Function to list the WAV files waiting in the input folder as (file path, main folder name) pairs
+def find_wav_files(input_folder):
+    wav_files = []
+    for root, dirs, files in os.walk(input_folder):
+        for file_name in files:
+            if file_name.endswith('.wav'):
+                # The main folder name is the parent folder of the input file
+                wav_files.append((os.path.join(root, file_name), os.path.basename(root)))
+    return wav_files
+
+# Function to name the chunk starting at start_ms, e.g. call_0-10.mp3
+def chunk_file_name_for(filename_without_extension, start_ms, chunk_ms, audio_format='mp3'):
+    start_time = start_ms // 1000  # Convert milliseconds to seconds
+    end_time = (start_ms + chunk_ms) // 1000
+    return f"{filename_without_extension}_{start_time}-{end_time}.{audio_format}"
+
+# Function to create the folders of an encoding profile in a recording folder, returns (converted file path, chunks folder).
+# A named profile writes converted/<profile>/ and chunks/<profile>/, the unnamed default profile converted/ and chunks/.
+def profile_folders(recording_folder, filename_without_extension, profile):
+    profile_name, audio_format = profile[:2]
+    profile_subfolders = [profile_name] if profile_name else []
+    converted_folder = os.path.join(recording_folder, "converted", *profile_subfolders)
+    chunks_folder = os.path.join(recording_folder, "chunks", *profile_subfolders)
+    os.makedirs(converted_folder, exist_ok=True)
+    os.makedirs(chunks_folder, exist_ok=True)
+    return os.path.join(converted_folder, f"{filename_without_extension}.{audio_format}"), chunks_folder
+
+# Function to build the ffmpeg options that downmix and resample to an encoding profile's channels and sample rate
+def layout_options(profile):
+    channels, sample_rate = profile[3:]
+    options = []
+    if channels:
+        options += ['-ac', str(channels)]
+    if sample_rate:
+        options += ['-ar', str(sample_rate)]
+    return options
+
+# Function to build the ffmpeg encoder options of an encoding profile
+def encoder_options(profile):
+    profile_name, audio_format, bitrate = profile[:3]
+    return ['-c:a', config.audio_encoders[audio_format], '-b:a', bitrate] + layout_options(profile)
+
+# Function to cut a recording into chunks of chunk_ms, returns [(start ms, end ms)]
+def fixed_chunk_boundaries(duration_ms, chunk_ms):
+    return [(start_ms, min(start_ms + chunk_ms, duration_ms)) for start_ms in range(0, duration_ms, chunk_ms)] or [(0, 0)]
+
+# Function to plan the chunks of a recording. pcm_buffers yields its PCM audio and is only read for silence chunking.
+# Returns (boundaries, silent chunks to leave out or None, chunk length for the chunk names or None for their own length).
+def plan_chunks(duration_ms, pcm_buffers, sample_width, channels, frame_rate):
+    if config.chunking_engine != 'silence':
+        return fixed_chunk_boundaries(duration_ms, config.chunk_length_ms), None, config.chunk_length_ms
+    # Imported here so NumPy is only needed for silence chunking
+    from .silence import frame_energies_db, silence_chunk_boundaries
+    energy_db = frame_energies_db(pcm_buffers, sample_width, channels, frame_rate)
+    boundaries, silent_chunks = silence_chunk_boundaries(energy_db, duration_ms)
+    return boundaries, silent_chunks if config.drop_silent_chunks else None, None
+
+# Function to read the audio of a wav file in buffers of whole frames of up to stream_buffer_bytes,
+# straight from the data chunk found by read_wav_header
+def read_wav_buffers(wav_file_path, wav_header):
+    channels, frame_rate, sample_width, data_offset, data_bytes = wav_header[1:6]
+    frame_bytes = channels * sample_width
+    buffer_bytes = max(1, config.stream_buffer_bytes // frame_bytes) * frame_bytes
+    remaining_bytes = data_bytes - data_bytes % frame_bytes
+    with open(wav_file_path, 'rb') as wav_file:
+        wav_file.seek(data_offset)
+        while remaining_bytes > 0:
+            frames = wav_file.read(min(buffer_bytes, remaining_bytes))
+            if not frames:
+                break
+            remaining_bytes -= len(frames)
+            yield frames
+
+# Function to build the segment muxer option that cuts at the chunk boundaries
+def segment_cut_option(boundaries):
+    if len(boundaries) == 1:
+        # A single chunk: one segment longer than the recording
+        return 'segment_time', str(boundaries[0][1] / 1000 + 1)
+    return 'segment_times', ",".join(f"{start_ms / 1000:.3f}" for start_ms, _ in boundaries[1:])
+
+# Function to cut an encoded file into chunks with a single ffmpeg run that copies the stream instead of re-encoding
+def segment_encoded(converted_file_path, chunks_folder, filename_without_extension, chunk_plan, audio_format='mp3'):
+    segment_prefix = os.path.join(chunks_folder, f".{filename_without_extension}_segment_")
+    cut_option, cut_value = segment_cut_option(chunk_plan[0])
+    count(ffmpeg_runs=1)
+    subprocess.run([AudioSegment.converter, '-y', '-loglevel', 'error', '-i', converted_file_path,
+                    '-map', '0:a', '-c', 'copy', '-f', 'segment', f'-{cut_option}', cut_value,
+                    '-reset_timestamps', '1', f"{segment_prefix}%06d.{audio_format}"],
+                   check=True, capture_output=True)
+    return collect_segments(segment_prefix, chunks_folder, filename_without_extension, chunk_plan, audio_format)
+
+# Function to rename the numbered segments written by ffmpeg to the chunk file names, removing the silent ones.
+# Chunk files are (local file path, file name, start ms, end ms).
+def collect_segments(segment_prefix, chunks_folder, filename_without_extension, chunk_plan, audio_format='mp3'):
+    boundaries, silent_chunks, chunk_ms = chunk_plan
+    expected_count = len(boundaries)
+    segments = sorted(glob.glob(f"{glob.escape(segment_prefix)}*.{audio_format}"))
+
+    # Encoder padding can leave a sliver of a frame after the last chunk
+    for segment in segments[expected_count:]:
+        os.remove(segment)
+    if len(segments) < expected_count:
+        for segment in segments:
+            os.remove(segment)
+        raise RuntimeError(f"expected {expected_count} segments, ffmpeg produced {len(segments)}")
+
+    chunk_files = []
+    for index, (segment, (start_ms, end_ms)) in enumerate(zip(segments, boundaries)):
+        if silent_chunks is not None and silent_chunks[index]:
+            os.remove(segment)
+            continue
+        chunk_file_name = chunk_file_name_for(filename_without_extension, start_ms, chunk_ms or end_ms - start_ms, audio_format)
+        chunk_file_path = os.path.join(chunks_folder, chunk_file_name)
+        os.replace(segment, chunk_file_path)
+        chunk_files.append((chunk_file_path, chunk_file_name, start_ms, end_ms))
+        logging.info(f"Moving chunk {chunk_file_name} to completed/chunks")
+    if len(chunk_files) < expected_count:
+        logging.info(f"{expected_count - len(chunk_files)} silent chunk(s) of {filename_without_extension} left out.")
+    return chunk_files
+
+# Function to escape a file name for ffmpeg's tee muxer
+def escape_tee_path(path):
+    for character in "\\|[]:'":
+        path = path.replace(character, "\\" + character)
+    return path
+
+# Function to convert a wav file to every encoding profile while reading it in fixed-size buffers.
+# outputs are (profile, converted file path, chunks folder). Each profile gets its own ffmpeg encoder, fed the
+# same buffers through a pipe so the encoders run in parallel, and its output is teed into the full file and
+# the segment muxer, so chunks are written as encoding goes and memory stays bounded by the buffer.
+# Silence chunking reads the file once more beforehand, as the cuts must be known when encoding starts.
+# Returns the chunk files of every output.
+def stream_encode_wav(wav_file_path, wav_header, outputs, filename_without_extension):
+    format_tag, channels, frame_rate, sample_width = wav_header[:4]
+    duration_ms = wav_header[6]
+    chunk_plan = plan_chunks(duration_ms, read_wav_buffers(wav_file_path, wav_header), sample_width, channels, frame_rate)
+    cut_option, cut_value = segment_cut_option(chunk_plan[0])
+
+    processes = []
+    for profile, converted_file_path, chunks_folder in outputs:
+        audio_format = profile[1]
+        segment_prefix = os.path.join(chunks_folder, f".{filename_without_extension}_segment_")
+        tee_outputs = (f"[f={audio_format}]{escape_tee_path(converted_file_path)}|"
+                       f"[f=segment:{cut_option}={cut_value}:reset_timestamps=1]{escape_tee_path(segment_prefix)}%06d.{audio_format}")
+        processes.append(subprocess.Popen([AudioSegment.converter, '-y', '-loglevel', 'error',
+                                           '-f', config.pcm_formats[sample_width], '-ar', str(frame_rate), '-ac', str(channels),
+                                           '-i', 'pipe:0', '-map', '0:a'] + encoder_options(profile) + ['-f', 'tee', tee_outputs],
+                                          stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE))
+
+    count(ffmpeg_runs=len(processes))
+    writing = list(processes)
+    try:
+        for frames in read_wav_buffers(wav_file_path, wav_header):
+            for process in list(writing):
+                try:
+                    process.stdin.write(frames)
+                except BrokenPipeError:
+                    # This ffmpeg exited early, its error output is reported below
+                    writing.remove(process)
+            if not writing:
+                break
+    finally:
+        for process in processes:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+    error_outputs = [process.stderr.read().decode(errors='replace') for process in processes]
+    errors = [error_output.strip() for process, error_output in zip(processes, error_outputs) if process.wait() != 0]
+    if errors:
+        raise RuntimeError(f"ffmpeg failed: {'; '.join(errors)}")
+
+    return [collect_segments(os.path.join(chunks_folder, f".{filename_without_extension}_segment_"), chunks_folder,
+                             filename_without_extension, chunk_plan, profile[1])
+            for profile, converted_file_path, chunks_folder in outputs]
+
+# Function to encode every chunk separately, one ffmpeg run per chunk
+def export_chunks(sound, chunks_folder, filename_without_extension, chunk_plan, profile):
+    boundaries, silent_chunks, chunk_ms = chunk_plan
+    audio_format = profile[1]
+    chunk_files = []
+    try:
+        for index, (start_ms, end_ms) in enumerate(boundaries):
+            if silent_chunks is not None and silent_chunks[index]:
+                continue
+            chunk_file_name = chunk_file_name_for(filename_without_extension, start_ms, chunk_ms or end_ms - start_ms, audio_format)
+            chunk_file_path = os.path.join(chunks_folder, chunk_file_name)
+            chunk = sound[start_ms:end_ms]
+            export_audio(chunk, chunk_file_path, profile)
+            chunk_files.append((chunk_file_path, chunk_file_name, start_ms, end_ms))
+            logging.info(f"Moving chunk {chunk_file_name} to completed/chunks")
+    except Exception as e:
+        logging.error(f"Error splitting {audio_format} file into chunks: {e}")
+    return chunk_files
+
+# Function to encode a decoded sound with the settings of an encoding profile
+def export_audio(sound, file_path, profile):
+    profile_name, audio_format, bitrate = profile[:3]
+    count(ffmpeg_runs=1)
+    sound.export(file_path, format=audio_format, codec=config.audio_encoders[audio_format], bitrate=bitrate,
+                 parameters=layout_options(profile))
+
+# Function to encode a decoded sound for one output, returns (converted file exported, chunk files).
+# parent_span is the span of the file's conversion, which the export spans count towards from any thread.
+def export_profile(sound, chunk_plan, output, file_name, parent_span=None):
+    profile, converted_file_path, chunks_folder = output
+    filename_without_extension = os.path.splitext(file_name)[0]
+    converted_file_name = os.path.basename(converted_file_path)
+    converted_exported = False
+    with span('export', file_name, parent_span) as export_span:
+        try:
+            export_audio(sound, converted_file_path, profile)
+            converted_exported = True
+            logging.info(f"Converted file {converted_file_name} moved to completed/converted.")
+        except Exception as e:
+            logging.error(f"Error moving converted {converted_file_name} to completed/converted: {e}")
+
+    # Split the converted file into chunks, segmenting the encoded file in one pass when it is available
+    chunk_files = None
+    with span('chunk_export', file_name, export_span['parent']):
+        if config.chunking_engine in ('segment', 'silence') and converted_exported:
+            try:
+                chunk_files = segment_encoded(converted_file_path, chunks_folder, filename_without_extension, chunk_plan, profile[1])
+            except Exception as e:
+                logging.warning(f"Error segmenting {converted_file_name}, exporting chunks one by one: {e}")
+        if chunk_files is None:
+            chunk_files = export_chunks(sound, chunks_folder, filename_without_extension, chunk_plan, profile)
+    return converted_exported, chunk_files
+
+# Function to remove what a failed encoding pass left in the outputs, so the next pass starts from empty folders
+def clear_outputs(outputs):
+    for profile, converted_file_path, chunks_folder in outputs:
+        if os.path.exists(converted_file_path):
+            os.remove(converted_file_path)
+        shutil.rmtree(chunks_folder, ignore_errors=True)
+        os.makedirs(chunks_folder, exist_ok=True)
+
+# Function to convert a wav file to every encoding profile, returns (converted file exported, chunk files) per output.
+# The audio is decoded once, in memory or as a stream, and shared by the profiles. A failed streaming pass is
+# retried from an in-memory decode, the way the segment engine falls back to exporting chunks one by one.
+def encode_wav(original_file_path, wav_header, sound, streaming, outputs, filename_without_extension):
+    file_name = os.path.basename(original_file_path)
+    if streaming:
+        # Convert and split into chunks in one streaming pass over the original file
+        try:
+            with span('stream_encode', file_name):
+                chunk_file_lists = stream_encode_wav(original_file_path, wav_header, outputs, filename_without_extension)
+            for profile, converted_file_path, chunks_folder in outputs:
+                logging.info(f"Converted file {os.path.basename(converted_file_path)} moved to completed/converted.")
+            return [(True, chunk_files) for chunk_files in chunk_file_lists]
+        except Exception as e:
+            logging.warning(f"Error streaming {file_name} to its encoding profiles and chunks, decoding it in memory instead: {e}")
+        try:
+            clear_outputs(outputs)
+            with span('decode', file_name):
+                sound = AudioSegment.from_wav(original_file_path)
+        except Exception as e:
+            logging.error(f"Error decoding WAV file {original_file_path}: {e}")
+            return [(False, [])] * len(outputs)
+
+    try:
+        chunk_plan = plan_chunks(len(sound), [sound.raw_data], sound.sample_width, sound.channels, sound.frame_rate)
+    except Exception as e:
+        logging.warning(f"Error finding the silences of {file_name}, cutting fixed-length chunks: {e}")
+        chunk_plan = fixed_chunk_boundaries(len(sound), config.chunk_length_ms), None, config.chunk_length_ms
+
+    conversion_span = current_span()
+    if len(outputs) == 1:
+        return [export_profile(sound, chunk_plan, outputs[0], file_name, conversion_span)]
+    # Every export runs its own ffmpeg, so the profiles encode in parallel from threads
+    with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+        return list(executor.map(lambda output: export_profile(sound, chunk_plan, output, file_name, conversion_span), outputs))
+
+# Function to move a wav file that cannot be converted to failed/<yymmdd>/<name>/
+def move_to_failed(wav_file_path, main_folder_name, failed_folder):
+    file_name = os.path.basename(wav_file_path)
+    failed_file_folder = os.path.join(failed_folder, main_folder_name, file_name[:-4])
+    os.makedirs(failed_file_folder, exist_ok=True)
+    os.rename(wav_file_path, os.path.join(failed_file_folder, file_name))
+    logging.error(f"Moving WAV file {wav_file_path} to failed folder.")
+
+# Function to give up on a recording that was moved into processing but could not be encoded: the original goes
+# to the failed folder and the partly written recording folder is removed, so nothing half converted is promoted
+def fail_recording(original_file_path, recording_folder, main_folder_name, failed_folder):
+    move_to_failed(original_file_path, main_folder_name, failed_folder)
+    shutil.rmtree(recording_folder, ignore_errors=True)
+
+# Function to convert one wav file to every encoding profile and create chunks.
+# It runs in a worker process and does no database work: it returns (file name, status, processed files, cache entries,
+# recording folder, wav header, failure reason, spans) where processed files are (local file path, file name, chunk start ms,
+# chunk end ms), the chunk positions being None for the original and converted files, cache entries are
+# (cache key, hit, size in bytes, chunk count, bitrate), recording folder is processing/<yymmdd>/<name>
+# (None for failed files), wav header is what read_wav_header parsed (None when it failed), failure reason
+# says why a failed file could not be converted and spans are the timings of the conversion, for the writer to record.
+def convert_wav_file(wav_file_path, main_folder_name, processing_folder, failed_folder, content_hash=None):
+    with span('conversion', os.path.basename(wav_file_path)):
+        result = convert_recording(wav_file_path, main_folder_name, processing_folder, failed_folder, content_hash)
+    return result + (take_spans(),)
+
+# Function to do the conversion of convert_wav_file, returns its result without the spans
+def convert_recording(wav_file_path, main_folder_name, processing_folder, failed_folder, content_hash=None):
+    file_name = os.path.basename(wav_file_path)
+    logging.info(f"Processing WAV file: {file_name}")
+    processed_files = []
+
+    # Check the headers against the file before paying for a hash, decode or encode
+    try:
+        wav_header = read_wav_header(wav_file_path)
+    except (OSError, ValueError) as e:
+        logging.error(f"WAV file {file_name} failed validation: {e}")
+        move_to_failed(wav_file_path, main_folder_name, failed_folder)
+        return file_name, 'failed', processed_files, [], None, None, f"invalid wav: {e}"
+    count(audio_ms=wav_header[6])
+
+    # Look the audio up in the conversion cache before paying for a decode; it is only skipped when every profile is cached
+    cache_keys = None
+    if config.conversion_cache_enabled:
+        try:
+            content_hash = content_hash or hash_file(wav_file_path)
+            cache_keys = [conversion_cache_key(content_hash, profile) for profile in config.encoding_profiles]
+        except Exception as e:
+            logging.warning(f"Error hashing {file_name} for the conversion cache: {e}")
+    cache_hit = cache_keys is not None and all(os.path.isdir(os.path.join(config.cache_folder, cache_key)) for cache_key in cache_keys)
+
+    # Stream integer PCM from the parsed data chunk, otherwise load the wav file
+    sound = None
+    streaming = config.decode_mode == 'stream'
+    if streaming and not cache_hit and not is_streamable(wav_header):
+        streaming = False
+        logging.warning(f"Cannot stream {file_name} (format tag {wav_header[0]}, {wav_header[3]}-byte samples), decoding it in memory.")
+    try:
+        if not streaming and not cache_hit:
+            with span('decode', file_name):
+                sound = AudioSegment.from_wav(wav_file_path)
+    except Exception as e:
+        # Log the error and move the file to the failed folder
+        logging.error(f"Error decoding WAV file {wav_file_path}: {e}")
+        move_to_failed(wav_file_path, main_folder_name, failed_folder)
+        return file_name, 'failed', processed_files, [], None, wav_header, f"decode error: {e}"
+
+    # Determine the destination folder based on successful processing
+    destination_folder = os.path.join(processing_folder, main_folder_name)
+
+    # Create a folder in the processing directory
+    os.makedirs(destination_folder, exist_ok=True)
+
+    # Get filename without extension
+    filename_without_extension = os.path.splitext(file_name)[0]
+
+    # The recording's folder is promoted to completed as a whole once it is recorded
+    recording_folder = os.path.join(destination_folder, filename_without_extension)
+
+    # Create a subfolder inside the main folder for original files
+    original_folder = os.path.join(destination_folder, filename_without_extension, "original")
+    os.makedirs(original_folder, exist_ok=True)
+
+    # Move the original wav file to the completed/original folder
+    original_file_path = os.path.join(original_folder, file_name)
+    try:
+        os.rename(wav_file_path, original_file_path)
+        processed_files.append((original_file_path, file_name, None, None))
+        logging.info(f"Original file {file_name} moved to completed/original.")
+    except Exception as e:
+        logging.error(f"Error moving {file_name} to completed/original: {e}")
+
+    # Create the converted and chunks subfolders of every encoding profile
+    outputs = [(profile,) + profile_folders(recording_folder, filename_without_extension, profile) for profile in config.encoding_profiles]
+
+    if cache_hit:
+        restored_files = []
+        restored = True
+        with span('cache_restore', file_name):
+            for cache_key, (profile, converted_file_path, chunks_folder) in zip(cache_keys, outputs):
+                chunk_files = restore_from_cache(cache_key, converted_file_path, chunks_folder, filename_without_extension)
+                if chunk_files is None:
+                    restored = False
+                    break
+                restored_files.append((converted_file_path, os.path.basename(converted_file_path), None, None))
+                restored_files.extend(chunk_files)
+        if restored:
+            processed_files.extend(restored_files)
+            logging.info(f"Converted files of {file_name} and their chunks restored from the conversion cache.")
+            return file_name, 'completed', processed_files, [(cache_key, True, None, None, None) for cache_key in cache_keys], recording_folder, wav_header, None
+        # An entry went away since the lookup, convert the original after all. The links restored so far are
+        # removed first, so encoding never writes through them into the cache.
+        for subfolder in ("converted", "chunks"):
+            shutil.rmtree(os.path.join(recording_folder, subfolder), ignore_errors=True)
+        outputs = [(profile,) + profile_folders(recording_folder, filename_without_extension, profile) for profile in config.encoding_profiles]
+        streaming = False
+        try:
+            with span('decode', file_name):
+                sound = AudioSegment.from_wav(original_file_path)
+        except Exception as e:
+            logging.error(f"Error decoding WAV file {original_file_path}: {e}")
+            fail_recording(original_file_path, recording_folder, main_folder_name, failed_folder)
+            return file_name, 'failed', [], [], None, wav_header, f"decode error: {e}"
+
+    cache_entries = []
+    encoded = encode_wav(original_file_path, wav_header, sound, streaming, outputs, filename_without_extension)
+    failed_profiles = [profile[0] or profile[1] for (profile, _, _), (converted_exported, _) in zip(outputs, encoded) if not converted_exported]
+    if failed_profiles:
+        logging.error(f"Encoding {file_name} failed for profile(s) {', '.join(failed_profiles)}.")
+        fail_recording(original_file_path, recording_folder, main_folder_name, failed_folder)
+        return file_name, 'failed', [], [], None, wav_header, f"encode error: {', '.join(failed_profiles)}"
+    for index, ((profile, converted_file_path, chunks_folder), (converted_exported, chunk_files)) in enumerate(zip(outputs, encoded)):
+        if converted_exported:
+            processed_files.append((converted_file_path, os.path.basename(converted_file_path), None, None))
+        processed_files.extend(chunk_files)
+
+        # Only a complete conversion is worth caching
+        if cache_keys is not None and converted_exported and chunk_files:
+            try:
+                stored = store_in_cache(cache_keys[index], converted_file_path, chunk_files, filename_without_extension)
+                if stored is not None:
+                    cache_entries.append((cache_keys[index], False) + stored + (profile[2],))
+            except Exception as e:
+                logging.warning(f"Error storing {file_name} in the conversion cache: {e}")
+
+    return file_name, 'completed', processed_files, cache_entries, recording_folder, wav_header, None
+
+# Function to move a recording's folder from processing to completed with a single rename.
+# A folder left by an earlier conversion of the same recording is replaced.
+def promote_recording(recording_folder, completed_recording_folder):
+    os.makedirs(os.path.dirname(completed_recording_folder), exist_ok=True)
+    replaced_folder = None
+    if os.path.exists(completed_recording_folder):
+        replaced_folder = f"{completed_recording_folder}.replaced.{os.getpid()}"
+        os.rename(completed_recording_folder, replaced_folder)
+    try:
+        os.rename(recording_folder, completed_recording_folder)
+    except OSError:
+        if replaced_folder is not None:
+            os.rename(replaced_folder, completed_recording_folder)
+        raise
+    if replaced_folder is not None:
+        shutil.rmtree(replaced_folder, ignore_errors=True)
+
+# Function to record the result of one conversion in the database and promote the recording to completed,
+# called from the single writer. The rows point at completed and the rename happens inside the transaction,
+# so a failed rename rolls the rows back and the database never points at processing.
+# job is the (job id, owner) of the conversion job, finished in the same transaction.
+def record_conversion_result(conn, result, processing_folder, completed_folder, job=None):
+    with span('db_write', result[0]):
+        write_conversion_result(conn, result, processing_folder, completed_folder, job)
+
+# Function to do the database work of record_conversion_result; the conversion's spans are written in its transaction
+def write_conversion_result(conn, result, processing_folder, completed_folder, job=None):
+    file_name, status, processed_files, cache_entries, recording_folder, wav_header, failure_reason, spans = result
+    current_date = datetime.now().strftime("%y-%m-%d")
+
+    completed_recording_folder = None
+    if recording_folder is not None:
+        completed_recording_folder = os.path.join(completed_folder, os.path.relpath(recording_folder, processing_folder))
+        processed_files = [(os.path.join(completed_recording_folder, os.path.relpath(local_file_path, recording_folder)), processed_file_name, chunk_start_ms, chunk_end_ms)
+                           for local_file_path, processed_file_name, chunk_start_ms, chunk_end_ms in processed_files]
+
+    # Insert the original, converted and chunk files and update the original's status in one transaction
+    try:
+        with database_lock, conn:
+            if completed_recording_folder is not None:
+                # Rows of an earlier conversion of the same recording are replaced along with its folder
+                prefix = completed_recording_folder + os.sep
+                conn.execute("DELETE FROM ProcessedFiles WHERE substr(local_file_path, 1, ?) = ?", (len(prefix), prefix))
+            # Rows are keyed on their path, so a collision fails the transaction instead of replacing another file's row
+            conn.executemany("INSERT INTO ProcessedFiles (local_file_path, source_file_name, status, created_date, updated_date, chunk_start_ms, chunk_end_ms) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(local_file_path, processed_file_name, 'processed', current_date, current_date, chunk_start_ms, chunk_end_ms)
+                              for local_file_path, processed_file_name, chunk_start_ms, chunk_end_ms in processed_files])
+            # The parsed format is kept so later stages never probe the file again
+            format_tag, channels, frame_rate, sample_width, _, _, duration_ms = wav_header or (None,) * 7
+            conn.execute("""UPDATE SourceFile SET status = ?, updated_date = ?, duration_ms = ?, sample_rate = ?, channels = ?, sample_width = ?,
+                            failure_reason = ? WHERE source_file_name = ?""",
+                         (status, current_date, duration_ms, frame_rate, channels, sample_width, failure_reason, file_name))
+            for cache_entry in cache_entries:
+                record_cache_entry(conn, cache_entry)
+            record_spans(conn, spans)
+            if job is not None:
+                finish_job(conn, job[0], job[1], status)
+            if completed_recording_folder is not None:
+                promote_recording(recording_folder, completed_recording_folder)
+        logging.info(f"{len(processed_files)} file(s) of {file_name} inserted to database(ProcessedFiles), status set to '{status}'")
+    except Exception as e:
+        logging.error(f"Error recording {file_name} with status '{status}' in the database: {e}")
+
+# Function to queue the WAV files waiting in the input folder, e.g. copied there by hand or left by an earlier run
+def enqueue_input_files(input_folder, database_name):
+    conn = get_connection(database_name)
+    with database_lock, conn:
+        enqueue_jobs(conn, find_wav_files(input_folder))
+
+# Function to convert the queued wav files to mp3 and create chunks, fanning them out over a process pool.
+# Jobs are claimed from the database as workers free up, so several of these can run at once, on this or
+# other hosts sharing the database and work folders. A long-running caller can pass its own executor so the
+# worker processes are reused between calls. Returns the number of files converted.
+def convert_wav_to_mp3(input_folder, processing_folder, completed_folder, failed_folder, database_name, workers=None, executor=None):
+    workers = workers or config.conversion_workers
+    conn = get_connection(database_name)
+    enqueue_input_files(input_folder, database_name)
+
+    owner = worker_identity()
+    active_jobs = set()
+    own_executor = executor is None and workers > 1
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    if executor is not None:
+        # Start the worker processes before the heartbeat thread, so they are not forked while it holds locks
+        executor.submit(os.getpid).result()
+    stop_heartbeat = start_heartbeat(database_name, owner, active_jobs)
+    converted_count = 0
+    try:
+        if executor is None:
+            while True:
+                jobs = claim_jobs(database_name, owner, processing_folder, 1)
+                if not jobs:
+                    break
+                job_id, wav_file_path, main_folder_name, checksum = jobs[0]
+                active_jobs.add(job_id)
+                try:
+                    result = convert_wav_file(wav_file_path, main_folder_name, processing_folder, failed_folder, checksum)
+                    record_conversion_result(conn, result, processing_folder, completed_folder, (job_id, owner))
+                    converted_count += 1
+                except Exception as e:
+                    # The job is no longer renewed, so it is queued again once its lease expires
+                    logging.error(f"Error converting {wav_file_path}: {e}")
+                finally:
+                    active_jobs.discard(job_id)
+        else:
+            # Workers only convert, this process is the single writer of the results
+            futures = {}
+            while True:
+                for job_id, wav_file_path, main_folder_name, checksum in claim_jobs(database_name, owner, processing_folder, workers - len(futures)):
+                    active_jobs.add(job_id)
+                    futures[executor.submit(convert_wav_file, wav_file_path, main_folder_name, processing_folder, failed_folder, checksum)] = (job_id, wav_file_path)
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id, wav_file_path = futures.pop(future)
+                    try:
+                        record_conversion_result(conn, future.result(), processing_folder, completed_folder, (job_id, owner))
+                        converted_count += 1
+                    except Exception as e:
+                        logging.error(f"Error converting {wav_file_path}: {e}")
+                    finally:
+                        active_jobs.discard(job_id)
+    finally:
+        stop_heartbeat.set()
+        if own_executor:
+            executor.shutdown()
+
+    if config.conversion_cache_enabled and converted_count:
+        evict_conversion_cache(database_name)
+    return converted_count
+
+# Function to delete the empty main (dated) folders of a directory
+def delete_empty_main_folders(input_folder):
+    for item in os.listdir(input_folder):
+        item_path = os.path.join(input_folder, item)
+        if os.path.isdir(item_path) and not os.listdir(item_path):
+            os.rmdir(item_path)
+
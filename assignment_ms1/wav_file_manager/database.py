@@ -0,0 +1,313 @@
+import os
+import sys
+import sqlite3
+import logging
+import threading
+
+from . import config
+
+
+# One database connection per process and database, opened on first use. Threads share it,
+# so writers hold database_lock for the whole of their transaction.
+database_connections = {}
+database_lock = threading.RLock()
+
+# Function to get this process's connection to the database, by default in WAL mode so readers don't block the writer.
+# WAL needs shared memory between the processes using the database, so a database shared by several hosts
+# over network storage uses a rollback journal instead (database_journal_mode 'DELETE').
+def get_connection(database_name):
+    key = (os.getpid(), database_name)
+    conn = database_connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(database_name, timeout=30, check_same_thread=False)
+        conn.execute(f"PRAGMA journal_mode={config.database_journal_mode}")
+        conn.execute("PRAGMA synchronous=NORMAL" if config.database_journal_mode == 'WAL' else "PRAGMA synchronous=FULL")
+        database_connections[key] = conn
+    return conn
+
+# Function to close the connections opened by this process
+def close_connections():
+    for key in [key for key in database_connections if key[0] == os.getpid()]:
+        database_connections.pop(key).close()
+
+# Function to add a column to a table created by an older version of the script
+def add_column_if_missing(cursor, table_name, column_name, column_definition):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    if column_name not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_definition}")
+        logging.info(f"Column {column_name} added to table {table_name}.")
+
+# Migration 1: SourceFile, ProcessedFiles and SyncManifest tables
+def create_tables(cursor):
+    # Create SourceFile table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS SourceFile (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        source_file_name TEXT UNIQUE,
+                        local_file_path TEXT,
+                        file_size INTEGER,
+                        status TEXT,
+                        created_date TEXT,
+                        updated_date TEXT
+                    )''')
+    logging.info("Table SourceFile created in database.")
+    # Create ProcessedFiles table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ProcessedFiles (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        local_file_path TEXT UNIQUE,
+                        source_file_name TEXT UNIQUE,
+                        status TEXT,
+                        created_date TEXT,
+                        updated_date TEXT
+                    )''')
+    logging.info("Table ProcessedFiles created in database.")
+    # Create SyncManifest table, keyed on remote path, to tell new or changed remote files apart
+    cursor.execute('''CREATE TABLE IF NOT EXISTS SyncManifest (
+                        remote_path TEXT PRIMARY KEY,
+                        file_size INTEGER,
+                        mtime INTEGER,
+                        local_file_path TEXT,
+                        checksum TEXT,
+                        synced_date TEXT
+                    )''')
+    logging.info("Table SyncManifest created in database.")
+
+# Migration 2: checksum of the downloaded file in SourceFile
+def add_source_file_checksum(cursor):
+    add_column_if_missing(cursor, "SourceFile", "checksum", "TEXT")
+
+# Migration 3: indexes for the status and date lookups
+def create_status_and_date_indexes(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sourcefile_status ON SourceFile (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sourcefile_created_date ON SourceFile (created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processedfiles_status ON ProcessedFiles (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processedfiles_created_date ON ProcessedFiles (created_date)")
+    logging.info("Status and date indexes created in database.")
+
+# Migration 4: index of the conversion cache
+def create_conversion_cache_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ConversionCache (
+                        cache_key TEXT PRIMARY KEY,
+                        content_hash TEXT,
+                        bitrate TEXT,
+                        chunk_length_ms INTEGER,
+                        size_bytes INTEGER,
+                        chunk_count INTEGER,
+                        created_date TEXT,
+                        last_used REAL
+                    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversioncache_last_used ON ConversionCache (last_used)")
+    logging.info("Table ConversionCache created in database.")
+
+# Migration 5: fingerprints of the rendered report partitions
+def create_report_partition_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ReportPartition (
+                        report_date TEXT PRIMARY KEY,
+                        fingerprint TEXT,
+                        report_file TEXT,
+                        rendered_date TEXT
+                    )''')
+    logging.info("Table ReportPartition created in database.")
+
+# Migration 6: leased conversion jobs shared by the workers of every host
+def create_conversion_job_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ConversionJob (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        source_file_name TEXT UNIQUE,
+                        local_file_path TEXT,
+                        main_folder_name TEXT,
+                        checksum TEXT,
+                        state TEXT,
+                        owner TEXT,
+                        lease_expires REAL,
+                        attempts INTEGER DEFAULT 0,
+                        created_date TEXT,
+                        updated_date TEXT
+                    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversionjob_state ON ConversionJob (state, lease_expires)")
+    logging.info("Table ConversionJob created in database.")
+
+# Migration 7: position of each chunk in its recording
+def add_processed_file_boundaries(cursor):
+    add_column_if_missing(cursor, "ProcessedFiles", "chunk_start_ms", "INTEGER")
+    add_column_if_missing(cursor, "ProcessedFiles", "chunk_end_ms", "INTEGER")
+
+# Migration 8: archive holding a file packed by the retention engine
+def add_processed_file_archive_path(cursor):
+    add_column_if_missing(cursor, "ProcessedFiles", "archive_path", "TEXT")
+
+# Migration 9: format and duration parsed from the wav headers, and why a file failed
+def add_source_file_format(cursor):
+    add_column_if_missing(cursor, "SourceFile", "duration_ms", "INTEGER")
+    add_column_if_missing(cursor, "SourceFile", "sample_rate", "INTEGER")
+    add_column_if_missing(cursor, "SourceFile", "channels", "INTEGER")
+    add_column_if_missing(cursor, "SourceFile", "sample_width", "INTEGER")
+    add_column_if_missing(cursor, "SourceFile", "failure_reason", "TEXT")
+
+# Migration 10: timed spans of every run, per stage and per file
+def create_run_metrics_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS RunMetrics (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        run_id TEXT,
+                        command TEXT,
+                        stage TEXT,
+                        source_file_name TEXT,
+                        started REAL,
+                        seconds REAL,
+                        bytes INTEGER,
+                        audio_ms INTEGER,
+                        ffmpeg_runs INTEGER
+                    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runmetrics_run_id ON RunMetrics (run_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runmetrics_started ON RunMetrics (started)")
+    logging.info("Table RunMetrics created in database.")
+
+# Migration 11: ProcessedFiles keyed on local_file_path alone. The same file name is written by every encoding
+# profile of a format and recurs across day folders, so source_file_name loses its UNIQUE constraint. SQLite
+# cannot drop a constraint, so the table is rebuilt with its rows.
+def drop_processed_file_name_unique(cursor):
+    cursor.execute("DROP TABLE IF EXISTS ProcessedFiles_rebuilt")
+    cursor.execute('''CREATE TABLE ProcessedFiles_rebuilt (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        local_file_path TEXT UNIQUE,
+                        source_file_name TEXT,
+                        status TEXT,
+                        created_date TEXT,
+                        updated_date TEXT,
+                        chunk_start_ms INTEGER,
+                        chunk_end_ms INTEGER,
+                        archive_path TEXT
+                    )''')
+    cursor.execute('''INSERT INTO ProcessedFiles_rebuilt (id, local_file_path, source_file_name, status, created_date, updated_date,
+                                                          chunk_start_ms, chunk_end_ms, archive_path)
+                      SELECT id, local_file_path, source_file_name, status, created_date, updated_date, chunk_start_ms, chunk_end_ms, archive_path
+                      FROM ProcessedFiles''')
+    cursor.execute("DROP TABLE ProcessedFiles")
+    cursor.execute("ALTER TABLE ProcessedFiles_rebuilt RENAME TO ProcessedFiles")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processedfiles_status ON ProcessedFiles (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processedfiles_created_date ON ProcessedFiles (created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_processedfiles_source_file_name ON ProcessedFiles (source_file_name)")
+    logging.info("Table ProcessedFiles rebuilt without the UNIQUE constraint on source_file_name.")
+
+# Migration 12: days of the SourceFile report whose rows changed since they were rendered. Triggers mark the
+# created_date of every SourceFile row written, and of the SourceFile row of every ProcessedFiles row added or
+# removed for an original, so every writer is covered. changes counts the marks, so a day marked again while
+# it is being rendered stays marked. Every existing day is marked once so the reports start from the tables.
+def create_report_dirty_date_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS ReportDirtyDate (
+                        report_date TEXT PRIMARY KEY,
+                        changes INTEGER
+                    )''')
+    mark_date = '''INSERT INTO ReportDirtyDate (report_date, changes) SELECT {date}, 1 WHERE {date} IS NOT NULL
+                   ON CONFLICT (report_date) DO UPDATE SET changes = changes + 1;'''
+    mark_source_file_date = '''INSERT INTO ReportDirtyDate (report_date, changes)
+                               SELECT created_date, 1 FROM SourceFile WHERE source_file_name = {row}.source_file_name AND created_date IS NOT NULL
+                               ON CONFLICT (report_date) DO UPDATE SET changes = changes + 1;'''
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS report_dirty_source_file_insert AFTER INSERT ON SourceFile BEGIN {mark_date.format(date='NEW.created_date')} END")
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS report_dirty_source_file_update AFTER UPDATE ON SourceFile BEGIN
+                       {mark_date.format(date='NEW.created_date')} {mark_date.format(date='OLD.created_date')} END""")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS report_dirty_source_file_delete AFTER DELETE ON SourceFile BEGIN {mark_date.format(date='OLD.created_date')} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS report_dirty_processed_file_insert AFTER INSERT ON ProcessedFiles BEGIN {mark_source_file_date.format(row='NEW')} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS report_dirty_processed_file_delete AFTER DELETE ON ProcessedFiles BEGIN {mark_source_file_date.format(row='OLD')} END")
+    cursor.execute('''INSERT INTO ReportDirtyDate (report_date, changes)
+                      SELECT DISTINCT created_date, 1 FROM SourceFile WHERE created_date IS NOT NULL
+                      ON CONFLICT (report_date) DO UPDATE SET changes = changes + 1''')
+    logging.info("Table ReportDirtyDate and its triggers created in database.")
+
+# Migration 13: ReportPartition without its fingerprint column, which ReportDirtyDate replaced. The table is
+# rebuilt with its rows as in migration 11, since older SQLite versions cannot drop a column.
+def drop_report_partition_fingerprint(cursor):
+    cursor.execute("PRAGMA table_info(ReportPartition)")
+    if 'fingerprint' not in [row[1] for row in cursor.fetchall()]:
+        return
+    cursor.execute("DROP TABLE IF EXISTS ReportPartition_rebuilt")
+    cursor.execute('''CREATE TABLE ReportPartition_rebuilt (
+                        report_date TEXT PRIMARY KEY,
+                        report_file TEXT,
+                        rendered_date TEXT
+                    )''')
+    cursor.execute('''INSERT INTO ReportPartition_rebuilt (report_date, report_file, rendered_date)
+                      SELECT report_date, report_file, rendered_date FROM ReportPartition''')
+    cursor.execute("DROP TABLE ReportPartition")
+    cursor.execute("ALTER TABLE ReportPartition_rebuilt RENAME TO ReportPartition")
+    logging.info("Table ReportPartition rebuilt without the fingerprint column.")
+
+# Schema migrations in the order they are applied. The database's user_version is the number applied so far;
+# every migration is idempotent so databases created before versioning can run them all.
+schema_migrations = [
+    create_tables,
+    add_source_file_checksum,
+    create_status_and_date_indexes,
+    create_conversion_cache_table,
+    create_report_partition_table,
+    create_conversion_job_table,
+    add_processed_file_boundaries,
+    add_processed_file_archive_path,
+    add_source_file_format,
+    create_run_metrics_table,
+    drop_processed_file_name_unique,
+    create_report_dirty_date_table,
+    drop_report_partition_fingerprint,
+]
+
+# Function to bring the database schema up to date
+def migrate_database(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(schema_migrations[version:], start=version + 1):
+        with conn:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+        logging.info(f"Database migrated to version {number} ({migration.__name__}).")
+
+# Function to create the database and tables if they don't exist
+def create_database(database_name):
+    try:
+        migrate_database(get_connection(database_name))
+    except Exception as e:
+        logging.error(f"Error creating database: {e}")
+        raise e
+
+# Function to view database tables
+def view_database(database_name, table_name):
+     
+    cursor = get_connection(database_name).cursor()
+    cursor.execute(f'SELECT * FROM {table_name}')
+    data = cursor.fetchall()
+        
+    print(f"{table_name} table:")
+    if data:
+        # Imported here so commands that never print tables don't pay for it
+        from tabulate import tabulate
+        headers = [description[0] for description in cursor.description]
+        print(tabulate(data, headers=headers, tablefmt="grid"))
+        logging.info("Data fetched from database...")
+    else:
+        print(f"No data found in {table_name} table.Exiting...")
+        logging.error(f"No data found in {table_name} table.Exiting...")
+        sys.exit()
+
+def print_database(database_name, table_name):
+    try:
+        view_database(database_name, table_name)
+        print()
+        logging.info(f"Printing database {database_name}...")
+    except Exception as e:
+        logging.error(f"Error printing database {database_name}: {e}")
+        raise e
+
+# Function to count the SourceFile rows of every status
+def count_files_by_status(database_name):
+    cursor = get_connection(database_name).cursor()
+    cursor.execute("SELECT status, COUNT(*) FROM SourceFile GROUP BY status")
+    return dict(cursor.fetchall())
+
+def calculate_file_counts(database_name):
+    cursor = get_connection(database_name).cursor()
+
+    # Count processed, failed and deleted files in one pass over the status index
+    cursor.execute("SELECT status, COUNT(*) FROM SourceFile WHERE status IN ('completed', 'failed', 'deleted') GROUP BY status")
+    counts = dict(cursor.fetchall())
+    processed_files = counts.get('completed', 0)
+    failed_files = counts.get('failed', 0)
+    deleted_files = counts.get('deleted', 0)
+
+    return processed_files, failed_files, deleted_files
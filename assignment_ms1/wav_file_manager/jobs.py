@@ -0,0 +1,133 @@
+import os
+import time
+import socket
+import logging
+import threading
+from datetime import datetime
+
+from . import config
+from .database import get_connection, database_lock
+
+
+# Every WAV file to convert is a row of ConversionJob. A worker claims jobs by leasing them ('queued' -> 'leased')
+# in a single UPDATE, so concurrent workers on one or several hosts never get the same file, and keeps the lease
+# alive with heartbeats while converting. A lease that expires (the worker crashed or hung) is queued again, up to
+# job_max_attempts claims. Finished jobs are marked 'completed' or 'failed' together with their SourceFile row.
+
+# Function to name this worker in the leases it holds
+def worker_identity():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+# Function to queue (local file path, main folder name) pairs for conversion, within the caller's transaction.
+# A file already queued or leased is left alone; one converted before was downloaded again and is queued afresh.
+def enqueue_jobs(conn, wav_files):
+    current_date = datetime.now().strftime("%y-%m-%d")
+    conn.executemany("""INSERT INTO ConversionJob (source_file_name, local_file_path, main_folder_name, checksum, state, attempts, created_date, updated_date)
+                        VALUES (?, ?, ?, (SELECT checksum FROM SourceFile WHERE source_file_name = ?), 'queued', 0, ?, ?)
+                        ON CONFLICT(source_file_name) DO UPDATE SET local_file_path = excluded.local_file_path, main_folder_name = excluded.main_folder_name,
+                        checksum = excluded.checksum, state = 'queued', owner = NULL, lease_expires = NULL, attempts = 0, updated_date = excluded.updated_date
+                        WHERE ConversionJob.state NOT IN ('queued', 'leased')""",
+                     [(os.path.basename(local_file_path), local_file_path, main_folder_name, os.path.basename(local_file_path), current_date, current_date)
+                      for local_file_path, main_folder_name in wav_files])
+
+# Function to queue again the jobs whose lease expired, failing those claimed job_max_attempts times already
+def requeue_expired_leases(conn, now):
+    current_date = datetime.now().strftime("%y-%m-%d")
+    failed = conn.execute("""UPDATE ConversionJob SET state = 'failed', owner = NULL, lease_expires = NULL, updated_date = ?
+                             WHERE state = 'leased' AND lease_expires < ? AND attempts >= ? RETURNING source_file_name""",
+                          (current_date, now, config.job_max_attempts)).fetchall()
+    if failed:
+        conn.executemany("UPDATE SourceFile SET status = 'failed', updated_date = ? WHERE source_file_name = ?",
+                         [(current_date, source_file_name) for source_file_name, in failed])
+        logging.error(f"{len(failed)} conversion job(s) failed after {config.job_max_attempts} expired leases: {', '.join(name for name, in failed)}")
+    requeued = conn.execute("""UPDATE ConversionJob SET state = 'queued', owner = NULL, lease_expires = NULL, updated_date = ?
+                               WHERE state = 'leased' AND lease_expires < ?""", (current_date, now)).rowcount
+    if requeued:
+        logging.warning(f"{requeued} conversion job(s) with an expired lease queued again.")
+
+# Function to find a job's wav file. A worker that died mid-conversion left it in the processing folder,
+# from where it is moved back to where the job expects it.
+def locate_job_file(local_file_path, main_folder_name, processing_folder):
+    if os.path.exists(local_file_path):
+        return local_file_path
+    file_name = os.path.basename(local_file_path)
+    stranded_file_path = os.path.join(processing_folder, main_folder_name, os.path.splitext(file_name)[0], "original", file_name)
+    if os.path.exists(stranded_file_path):
+        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+        os.rename(stranded_file_path, local_file_path)
+        logging.info(f"Recovered {file_name} left in the processing folder by an interrupted conversion.")
+        return local_file_path
+    return None
+
+# Function to lease up to limit jobs to owner, returns [(job id, wav file path, main folder name, checksum)]
+def claim_jobs(database_name, owner, processing_folder, limit):
+    if limit <= 0:
+        return []
+    conn = get_connection(database_name)
+    now = time.time()
+    with database_lock, conn:
+        requeue_expired_leases(conn, now)
+        # One statement selects and leases the jobs, so no other worker can claim them in between
+        jobs = conn.execute("""UPDATE ConversionJob SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated_date = ?
+                               WHERE id IN (SELECT id FROM ConversionJob WHERE state = 'queued' ORDER BY id LIMIT ?)
+                               RETURNING id, local_file_path, main_folder_name, checksum""",
+                            (owner, now + config.job_lease_seconds, datetime.now().strftime("%y-%m-%d"), limit)).fetchall()
+
+    claimed = []
+    for job_id, local_file_path, main_folder_name, checksum in sorted(jobs):
+        wav_file_path = locate_job_file(local_file_path, main_folder_name, processing_folder)
+        if wav_file_path is None:
+            logging.error(f"WAV file {local_file_path} of conversion job {job_id} no longer exists.")
+            with database_lock, conn:
+                finish_job(conn, job_id, owner, 'failed')
+            continue
+        claimed.append((job_id, wav_file_path, main_folder_name, checksum))
+    return claimed
+
+# Function to extend the leases owner holds on job_ids, returns the number still held
+def renew_leases(database_name, owner, job_ids):
+    conn = get_connection(database_name)
+    placeholders = ", ".join("?" * len(job_ids))
+    with database_lock, conn:
+        renewed = conn.execute(f"UPDATE ConversionJob SET lease_expires = ? WHERE owner = ? AND state = 'leased' AND id IN ({placeholders})",
+                               [time.time() + config.job_lease_seconds, owner] + list(job_ids)).rowcount
+    if renewed < len(job_ids):
+        logging.warning(f"{len(job_ids) - renewed} conversion job lease(s) of {owner} expired before they were renewed.")
+    return renewed
+
+# Function to renew the leases of the jobs in active_jobs from a background thread, returns the event that stops it
+def start_heartbeat(database_name, owner, active_jobs):
+    stop_event = threading.Event()
+    def beat():
+        while not stop_event.wait(config.job_heartbeat_interval):
+            job_ids = list(active_jobs)
+            if not job_ids:
+                continue
+            try:
+                renew_leases(database_name, owner, job_ids)
+            except Exception as e:
+                logging.error(f"Error renewing conversion job leases: {e}")
+    threading.Thread(target=beat, name="job-heartbeat", daemon=True).start()
+    return stop_event
+
+# Function to mark a leased job 'completed' or 'failed', within the caller's transaction
+def finish_job(conn, job_id, owner, state):
+    current_date = datetime.now().strftime("%y-%m-%d")
+    finished = conn.execute("UPDATE ConversionJob SET state = ?, owner = NULL, lease_expires = NULL, updated_date = ? WHERE id = ? AND owner = ?",
+                            (state, current_date, job_id, owner)).rowcount
+    if finished:
+        return
+    # The lease expired but this conversion finished all the same: a job queued again is finished with it,
+    # one another worker has claimed since is left to that worker
+    finished = conn.execute("""UPDATE ConversionJob SET state = ?, owner = NULL, lease_expires = NULL, updated_date = ?
+                               WHERE id = ? AND (owner IS NULL OR state != 'leased')""", (state, current_date, job_id)).rowcount
+    if finished:
+        logging.warning(f"Conversion job {job_id} finished by {owner} after its lease was lost.")
+    else:
+        logging.warning(f"Conversion job {job_id} finished by {owner} after it was claimed by another worker, leaving it to that worker.")
+
+# Function to count the conversion jobs in each state
+def count_jobs_by_state(database_name):
+    cursor = get_connection(database_name).cursor()
+    cursor.execute("SELECT state, COUNT(*) FROM ConversionJob GROUP BY state")
+    return dict(cursor.fetchall())
@@ -0,0 +1,179 @@
+import os
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from . import config
+from .database import get_connection, database_lock
+
+
+# Instrumentation: work is timed in spans, one per stage of a command (source file None) and one per file
+# and step (download, decode, stream_encode, export, chunk_export, cache_restore, db_write and conversion
+# around a file's whole conversion). A span also counts the bytes transferred, the audio processed and the
+# ffmpeg runs started inside it, adding them to the spans it is nested in. Finished spans wait in this
+# process; worker processes hand theirs back with their results and the main process writes them all to
+# RunMetrics under the id of the command's run.
+
+# Finished spans of this process: (stage, source file name, started, seconds, bytes, audio ms, ffmpeg runs)
+finished_spans = []
+finished_spans_pid = os.getpid()
+spans_lock = threading.Lock()
+open_spans = threading.local()
+
+# The run of this process's command, set by start_run: (run id, command, started)
+current_run = None
+
+# Commands that download or convert, whose runs update the Prometheus textfile and are shown by latest_run
+pipeline_commands = ('sync', 'convert', 'watch', 'run')
+
+# Function to start the run of a command, under whose id the spans of this process are recorded
+def start_run(command):
+    global current_run
+    started = time.time()
+    current_run = (f"{datetime.fromtimestamp(started).strftime('%Y%m%d-%H%M%S-%f')}-{socket.gethostname()}-{os.getpid()}", command, started)
+    return current_run[0]
+
+# Function to get the finished spans of this process, called with spans_lock held. A forked worker process
+# starts without the spans its parent had waiting, so they are never handed back twice.
+def process_spans():
+    global finished_spans_pid
+    if finished_spans_pid != os.getpid():
+        finished_spans.clear()
+        finished_spans_pid = os.getpid()
+    return finished_spans
+
+# Function to get the counters of the innermost span open in this thread, or None
+def current_span():
+    stack = getattr(open_spans, 'stack', None)
+    return stack[-1] if stack else None
+
+# Function to time a block as a span of stage. The yielded counters are added to by count(); parent is the span
+# the counters also go to, by default the one open in this thread (pass it explicitly from other threads).
+@contextmanager
+def span(stage, source_file_name=None, parent=None):
+    counters = {'bytes': 0, 'audio_ms': 0, 'ffmpeg_runs': 0, 'parent': parent if parent is not None else current_span()}
+    if not hasattr(open_spans, 'stack'):
+        open_spans.stack = []
+    open_spans.stack.append(counters)
+    started = time.time()
+    start_time = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        open_spans.stack.pop()
+        with spans_lock:
+            process_spans().append((stage, source_file_name, started, time.perf_counter() - start_time,
+                                   counters['bytes'], counters['audio_ms'], counters['ffmpeg_runs']))
+
+# Function to count bytes, audio milliseconds or ffmpeg runs in the innermost open span and the spans around it
+def count(bytes=0, audio_ms=0, ffmpeg_runs=0):
+    counters = current_span()
+    with spans_lock:
+        while counters is not None:
+            counters['bytes'] += bytes
+            counters['audio_ms'] += audio_ms
+            counters['ffmpeg_runs'] += ffmpeg_runs
+            counters = counters['parent']
+
+# Function to take the finished spans of this process, e.g. to return them from a worker process
+def take_spans():
+    with spans_lock:
+        spans = process_spans()[:]
+        finished_spans.clear()
+    return spans
+
+# Function to write spans to RunMetrics under the current run, within the caller's transaction
+def record_spans(conn, spans):
+    if current_run is None or not spans:
+        return
+    run_id, command, _ = current_run
+    conn.executemany("""INSERT INTO RunMetrics (run_id, command, stage, source_file_name, started, seconds, bytes, audio_ms, ffmpeg_runs)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     [(run_id, command) + tuple(span_values) for span_values in spans])
+
+# Function to write the spans waiting in this process to the database
+def flush_spans(database_name):
+    spans = take_spans()
+    if current_run is None or not spans:
+        return
+    try:
+        conn = get_connection(database_name)
+        with database_lock, conn:
+            record_spans(conn, spans)
+    except Exception as e:
+        logging.error(f"Error recording {len(spans)} run metric span(s): {e}")
+
+# Function to finish the run of this process's command: its whole duration is recorded as a 'run' span,
+# everything waiting is written and, for the pipeline_commands, the Prometheus textfile is updated when one is configured
+def finish_run(database_name):
+    if current_run is None:
+        return
+    run_id, command, started = current_run
+    with spans_lock:
+        process_spans().append(('run', None, started, time.time() - started, 0, 0, 0))
+    flush_spans(database_name)
+    if config.metrics_textfile and command in pipeline_commands:
+        try:
+            write_prometheus_textfile(database_name, config.metrics_textfile, run_id)
+        except Exception as e:
+            logging.error(f"Error writing the metrics textfile {config.metrics_textfile}: {e}")
+
+# Function to total the spans of every stage, of one run or of every run since a timestamp.
+# Returns [(stage, spans, files, seconds, bytes, audio ms, ffmpeg runs)] in the order the stages started.
+def summarize_stages(database_name, run_id=None, since=None):
+    condition, parameter = ("run_id = ?", run_id) if run_id is not None else ("started >= ?", since or 0)
+    return get_connection(database_name).execute(f"""SELECT stage, COUNT(*), COUNT(DISTINCT source_file_name), TOTAL(seconds),
+                                                             TOTAL(bytes), TOTAL(audio_ms), TOTAL(ffmpeg_runs)
+                                                      FROM RunMetrics WHERE {condition} GROUP BY stage ORDER BY MIN(started)""",
+                                                  (parameter,)).fetchall()
+
+# Function to find the latest finished run of one of the pipeline_commands, returns (run id, command, started) or None
+def latest_run(database_name):
+    return get_connection(database_name).execute(f"""SELECT run_id, command, started FROM RunMetrics
+                                                      WHERE stage = 'run' AND command IN ({', '.join('?' * len(pipeline_commands))})
+                                                      ORDER BY started DESC LIMIT 1""", pipeline_commands).fetchone()
+
+# Function to format stage totals as lines of text, for the email and the metrics command
+def format_stage_summary(stage_summary):
+    lines = []
+    for stage, span_count, file_count, seconds, byte_count, audio_ms, ffmpeg_runs in stage_summary:
+        details = [f"{seconds:.1f}s"]
+        if file_count:
+            details.append(f"{file_count} file(s)")
+        if byte_count:
+            details.append(f"{byte_count / (1024 * 1024):.1f} MB")
+        if audio_ms:
+            details.append(f"{audio_ms / 1000:.0f}s of audio")
+        if ffmpeg_runs:
+            details.append(f"{ffmpeg_runs:.0f} ffmpeg run(s)")
+        lines.append(f"{stage} - {', '.join(details)}")
+    return lines
+
+# Function to write the stage totals of a run as a Prometheus textfile, for node_exporter's textfile collector.
+# The file is replaced in one rename so the collector never reads half of it.
+def write_prometheus_textfile(database_name, textfile_path, run_id):
+    run = get_connection(database_name).execute("SELECT command, MIN(started) FROM RunMetrics WHERE run_id = ?", (run_id,)).fetchone()
+    command = run[0]
+    metric_lines = []
+    for metric_name, help_text, column in (('stage_seconds', "Seconds spent in each stage, summed over its spans", 3),
+                                           ('stage_spans', "Spans timed in each stage", 1),
+                                           ('stage_files', "Files handled in each stage", 2),
+                                           ('stage_bytes', "Bytes transferred in each stage", 4),
+                                           ('stage_audio_seconds', "Seconds of audio processed in each stage", 5),
+                                           ('stage_ffmpeg_runs', "ffmpeg processes started in each stage", 6)):
+        metric_lines.append(f"# HELP wav_file_manager_{metric_name} {help_text} during the last run.")
+        metric_lines.append(f"# TYPE wav_file_manager_{metric_name} gauge")
+        for stage_totals in summarize_stages(database_name, run_id):
+            value = stage_totals[column] / 1000 if metric_name == 'stage_audio_seconds' else stage_totals[column]
+            metric_lines.append(f'wav_file_manager_{metric_name}{{command="{command}",stage="{stage_totals[0]}"}} {value:g}')
+    metric_lines.append("# HELP wav_file_manager_last_run_timestamp_seconds Start of the last run.")
+    metric_lines.append("# TYPE wav_file_manager_last_run_timestamp_seconds gauge")
+    metric_lines.append(f'wav_file_manager_last_run_timestamp_seconds{{command="{command}"}} {run[1]:.0f}')
+
+    temporary_path = f"{textfile_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as textfile:
+        textfile.write("\n".join(metric_lines) + "\n")
+    os.replace(temporary_path, textfile_path)
@@ -0,0 +1,92 @@
+import os
+import smtplib
+import logging
+from email import encoders
+from datetime import datetime, date
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+
+from . import config
+from .database import get_connection, calculate_file_counts
+from .metrics import flush_spans, summarize_stages, format_stage_summary
+
+
+# Function to send email
+def send_email(sender_email, sender_password, receiver_email, cc_email, subject, body, attachment_path=None, log_file_path=None):
+    msg = MIMEMultipart()
+    msg['From'] = sender_email
+    msg['To'] = receiver_email
+    msg['Cc'] = cc_email 
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain'))
+
+    if attachment_path:
+        with open(attachment_path, "rb") as attachment_file:
+            attachment = attachment_file.read()  # Read the attachment file
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(attachment)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', "attachment; filename= " + os.path.basename(attachment_path))
+            msg.attach(part)
+
+    if log_file_path:
+        with open(log_file_path, "rb") as log_file:
+            log_attachment = log_file.read()  # Read the log file
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(log_attachment)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', "attachment; filename= " + os.path.basename(log_file_path))
+            msg.attach(part)
+
+    # Use SSL for Gmail SMTP
+    server = smtplib.SMTP_SSL(config.smtp_host, config.smtp_port) if config.smtp_ssl else smtplib.SMTP(config.smtp_host, config.smtp_port)
+    server.login(sender_email, sender_password)
+    recipients = [receiver_email]  # Include CC recipient in the list of recipients
+    if cc_email:
+        recipients.append(cc_email)
+    server.sendmail(sender_email, recipients, msg.as_string())  # Send email to both To and CC recipients
+    server.quit()
+
+# Function to find the report rendered for today, or for the latest day, without rendering anything
+def find_report_file(database_name):
+    today_date = datetime.now().strftime("%y-%m-%d")
+    row = get_connection(database_name).execute("""SELECT report_file FROM ReportPartition
+                                                   ORDER BY report_date = ? DESC, report_date DESC LIMIT 1""", (today_date,)).fetchone()
+    return row[0] if row else None
+
+# Function to send the daily status email with the SourceFile report and the log file
+def send_status_email(database_name, attachment_path=None):
+    # Email details
+    sender_email, sender_password, receiver_email, cc_email = config.email_settings()
+    subject = 'Daily Status Report'
+
+    if attachment_path is None:
+        attachment_path = find_report_file(database_name)
+
+    # Calculate file counts
+    processed_files, failed_files, deleted_files = calculate_file_counts(database_name)
+
+    # Prepare email body
+    body = f"""Date - {datetime.now().strftime("%d/%m/%Y")}
+    Total files - {processed_files + failed_files + deleted_files}
+    Processed files - {processed_files}
+    Failed files - {failed_files}
+    Deleted files - {deleted_files}
+    """
+
+    # Add how long each stage took today, including this run's stages so far
+    try:
+        flush_spans(database_name)
+        midnight = datetime.combine(date.today(), datetime.min.time()).timestamp()
+        stage_lines = format_stage_summary(summarize_stages(database_name, since=midnight))
+        if stage_lines:
+            body += "Stage timings today\n" + "".join(f"    {line}\n" for line in stage_lines)
+    except Exception as e:
+        logging.error(f"Error summarizing today's stage timings for the email: {e}")
+
+    # Send email with attachment and log file
+    send_email(sender_email, sender_password, receiver_email, cc_email, subject, body, attachment_path, config.log_file_path)
+
+    logging.info("Email sent successfully with the source file report and log file.")
+    print("Email sent successfully with the source file report and log file.")
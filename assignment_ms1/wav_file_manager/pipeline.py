@@ -0,0 +1,112 @@
+import os
+import queue
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from . import config
+from .database import get_connection
+from .sync import download_folders_from_remote
+from .cache import evict_conversion_cache
+from .metrics import span, current_span
+from .jobs import worker_identity, claim_jobs, start_heartbeat
+from .convert import convert_wav_file, record_conversion_result, enqueue_input_files
+
+
+# Function to run download and conversion as a pipeline. A download thread queues each finished file for
+# conversion and signals it through a bounded queue; this thread claims the queued jobs for the conversion
+# pool and records the results. At most workers files are converting and pipeline_queue_size waiting,
+# beyond that the downloader blocks. Returns the number of files downloaded, like download_folders_from_remote.
+def run_pipeline(sftp, remote_path, input_folder, processing_folder, completed_folder, failed_folder, database_name, sftp_pool=None, workers=None, folder_dates=None):
+    workers = workers or config.conversion_workers
+    conn = get_connection(database_name)
+    work_queue = queue.Queue(maxsize=config.pipeline_queue_size)
+    download_result = {}
+
+    # Files left in the input folder by an earlier run are converted first
+    enqueue_input_files(input_folder, database_name)
+    owner = worker_identity()
+    active_jobs = set()
+    stop_download = threading.Event()
+    # The download thread has no span open, so its sync stage is nested in this thread's explicitly
+    pipeline_span = current_span()
+
+    # Function to queue a downloaded file for conversion, giving up once the conversion side has stopped
+    def queue_download(item):
+        while not stop_download.is_set():
+            try:
+                work_queue.put(item, timeout=config.pipeline_poll_seconds)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("the conversion side of the pipeline stopped")
+
+    def download():
+        try:
+            with span('sync', parent=pipeline_span):
+                download_result['count'] = download_folders_from_remote(sftp, remote_path, input_folder, database_name, sftp_pool, queue_download, folder_dates)
+        except Exception as e:
+            logging.error(f"Error downloading in pipelined mode: {e}")
+        finally:
+            # Tell the conversion side there is nothing more to come
+            try:
+                queue_download(None)
+            except RuntimeError:
+                pass
+
+    # Function to record the conversions that finished, waiting up to timeout (None waits for the first one)
+    def record_finished(futures, timeout=None):
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            job_id, wav_file_path = futures.pop(future)
+            try:
+                record_conversion_result(conn, future.result(), processing_folder, completed_folder, (job_id, owner))
+            except Exception as e:
+                logging.error(f"Error converting {wav_file_path}: {e}")
+            finally:
+                active_jobs.discard(job_id)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Start the worker processes before the download and heartbeat threads, so they are not forked while those hold locks
+        executor.submit(os.getpid).result()
+        stop_heartbeat = start_heartbeat(database_name, owner, active_jobs)
+        downloader = threading.Thread(target=download, name="pipeline-download")
+        downloader.start()
+
+        futures = {}
+        downloading = True
+        try:
+            while True:
+                for job_id, wav_file_path, main_folder_name, checksum in claim_jobs(database_name, owner, processing_folder, workers - len(futures)):
+                    active_jobs.add(job_id)
+                    futures[executor.submit(convert_wav_file, wav_file_path, main_folder_name, processing_folder, failed_folder, checksum)] = (job_id, wav_file_path)
+                # Keep at most workers files in the pool so back-pressure reaches the download queue
+                if futures and (len(futures) >= workers or not downloading):
+                    record_finished(futures)
+                elif downloading and futures:
+                    # Wait for the next download and the running conversions together, so finished recordings
+                    # are promoted and their slots freed without waiting for more downloads
+                    record_finished(futures, 0)
+                    try:
+                        if work_queue.get(timeout=config.pipeline_poll_seconds) is None:
+                            downloading = False
+                    except queue.Empty:
+                        pass
+                elif downloading:
+                    if work_queue.get() is None:
+                        downloading = False
+                else:
+                    break
+        finally:
+            stop_heartbeat.set()
+            # Stop a downloader blocked on the full queue if the conversion side ended early
+            stop_download.set()
+            while True:
+                try:
+                    work_queue.get_nowait()
+                except queue.Empty:
+                    break
+            downloader.join()
+    if config.conversion_cache_enabled:
+        evict_conversion_cache(database_name)
+    return download_result.get('count')
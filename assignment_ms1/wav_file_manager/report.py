@@ -0,0 +1,80 @@
+import os
+import logging
+import importlib.util
+import pandas as pd
+from datetime import datetime
+
+from . import config
+from .database import get_connection, database_lock
+
+
+# SourceFile rows of one day, with the status reconciled from the database: a file with a ProcessedFiles row
+# for its original has been processed, whatever its SourceFile status says, unless retention has deleted it since
+source_file_report_query = """SELECT s.id, s.source_file_name, s.local_file_path, s.file_size,
+                                     CASE WHEN s.status = 'deleted' THEN s.status
+                                          WHEN EXISTS (SELECT 1 FROM ProcessedFiles p WHERE p.source_file_name = s.source_file_name)
+                                          THEN 'completed' ELSE s.status END AS status,
+                                     s.created_date, s.updated_date, s.checksum, s.duration_ms, s.failure_reason
+                              FROM SourceFile s WHERE s.created_date = ? ORDER BY s.id"""
+
+# Libraries pandas can write each report format with
+report_format_libraries = {'parquet': ('pyarrow', 'fastparquet'), 'xlsx': ('openpyxl', 'xlsxwriter')}
+
+# Function to find the format the report is written in: the requested one, or csv if none of its libraries is installed
+def available_report_format(output_format):
+    libraries = report_format_libraries.get(output_format, ())
+    if libraries and not any(importlib.util.find_spec(library) for library in libraries):
+        logging.warning(f"Cannot write {output_format} report without {' or '.join(libraries)}, writing csv instead.")
+        return 'csv'
+    return output_format
+
+# Function to write one report partition in output_format, returns the report file path
+def write_report_partition(df, report_base_path, output_format):
+    report_file = f"{report_base_path}.{output_format}"
+    if output_format == 'parquet':
+        df.to_parquet(report_file, index=False)
+    elif output_format == 'xlsx':
+        df.to_excel(report_file, index=False)
+    else:
+        df.to_csv(report_file, index=False)
+    return report_file
+
+# Function to create the SourceFile report, one file per created date. Only the days marked in ReportDirtyDate
+# since they were last rendered, and days last rendered in another format, are read and written again, so the
+# cost of a run follows what changed rather than the whole history. Returns the report of today, or of the latest day.
+def create_source_file_report(database_name, report_folder, output_format=None):
+    # Days are compared against the format actually written, so a missing library does not re-render every day
+    output_format = available_report_format(output_format or config.report_format)
+    conn = get_connection(database_name)
+    partition_folder = os.path.join(report_folder, "SourceFile")
+    os.makedirs(partition_folder, exist_ok=True)
+
+    dirty_dates = dict(conn.execute("SELECT report_date, changes FROM ReportDirtyDate").fetchall())
+    for (report_date,) in conn.execute("SELECT report_date FROM ReportPartition WHERE report_file NOT LIKE ?", (f"%.{output_format}",)):
+        dirty_dates.setdefault(report_date, None)
+
+    rendered_partitions = []
+    for report_date in sorted(dirty_dates):
+        # Read data of this day from SourceFile table
+        df = pd.read_sql_query(source_file_report_query, conn, params=(report_date,))
+        report_file = write_report_partition(df, os.path.join(partition_folder, f"SourceFile_Report_{report_date}"), output_format)
+        rendered_partitions.append((report_date, report_file, datetime.now().strftime("%y-%m-%d")))
+
+    with database_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO ReportPartition (report_date, report_file, rendered_date) VALUES (?, ?, ?)",
+                         rendered_partitions)
+        # A day marked again while it was rendered keeps its mark for the next run
+        conn.executemany("DELETE FROM ReportDirtyDate WHERE report_date = ? AND changes = ?",
+                         [(report_date, changes) for report_date, changes in dirty_dates.items() if changes is not None])
+
+    # Today's report, or the latest day's when nothing was downloaded today
+    today_date = datetime.now().strftime("%y-%m-%d")
+    row = conn.execute("SELECT report_file FROM ReportPartition ORDER BY report_date = ? DESC, report_date DESC LIMIT 1", (today_date,)).fetchone()
+    report_file = row[0] if row else None
+
+    # Logging
+    print(f"SourceFile report: {len(rendered_partitions)} changed day(s) rendered, today's report is {report_file}")
+    logging.info(f"SourceFile report: {len(rendered_partitions)} changed day(s) rendered, today's report is {report_file}")
+
+    return report_file
+
@@ -0,0 +1,177 @@
+import os
+import shutil
+import logging
+import tarfile
+from datetime import date, datetime, timedelta
+
+from . import config
+from .database import get_connection, database_lock
+
+
+# Retention works on the artifact folders of completed recordings, completed/<yymmdd>/<name>/<artifact>, going by the
+# created_date of their ProcessedFiles rows. A whole folder is handled with one rename or one archive, and the rows of
+# a batch of folders are updated in one transaction.
+
+# Function to give the date before which rows are older than days, in the yy-mm-dd format of the tables
+def cutoff_date(days):
+    return (date.today() - timedelta(days=days)).strftime("%y-%m-%d")
+
+# Function to split a list into batches of batch_size
+def batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+# Function to count the bytes a folder frees when it is removed. Files hard linked elsewhere, e.g. into the
+# conversion cache, free nothing.
+def reclaimable_bytes(folder):
+    size_bytes = 0
+    for root, dirs, files in os.walk(folder):
+        for file_name in files:
+            stat = os.stat(os.path.join(root, file_name))
+            if stat.st_nlink == 1:
+                size_bytes += stat.st_size
+    return size_bytes
+
+# Function to find the expired artifact folders of a policy, returns [(artifact folder, [source file names])]
+def expired_artifact_folders(conn, completed_folder, artifact, days):
+    folders = {}
+    rows = conn.execute("SELECT local_file_path, source_file_name FROM ProcessedFiles WHERE status = 'processed' AND created_date < ?",
+                        (cutoff_date(days),))
+    for local_file_path, source_file_name in rows:
+        path_parts = os.path.relpath(local_file_path, completed_folder).split(os.sep)
+        # Only <yymmdd>/<name>/<artifact>/... paths inside completed are artifact files
+        if len(path_parts) < 4 or path_parts[0] == os.pardir or path_parts[2] != artifact:
+            continue
+        folders.setdefault(os.path.join(completed_folder, *path_parts[:3]), []).append(source_file_name)
+    return sorted(folders.items())
+
+# Function to move expired artifact folders to the deleted folder, keeping their <yymmdd>/<name>/<artifact> layout.
+# Their rows follow them with status 'deleted', as do the SourceFile rows of deleted originals. Returns the folders moved.
+def delete_artifacts(conn, expired_folders, artifact, completed_folder, deleted_folder):
+    moved_count = 0
+    current_date = datetime.now().strftime("%y-%m-%d")
+    for batch in batches(expired_folders, config.retention_batch_size):
+        moved = []
+        for artifact_folder, source_file_names in batch:
+            deleted_artifact_folder = os.path.join(deleted_folder, os.path.relpath(artifact_folder, completed_folder))
+            try:
+                os.makedirs(os.path.dirname(deleted_artifact_folder), exist_ok=True)
+                if os.path.exists(deleted_artifact_folder):
+                    # Left by an earlier conversion of the same recording
+                    shutil.rmtree(deleted_artifact_folder)
+                os.rename(artifact_folder, deleted_artifact_folder)
+                moved.append((artifact_folder + os.sep, deleted_artifact_folder + os.sep, source_file_names))
+            except OSError as e:
+                logging.error(f"Error moving {artifact_folder} to the deleted folder: {e}")
+
+        with database_lock, conn:
+            conn.executemany("""UPDATE ProcessedFiles SET status = 'deleted', updated_date = ?, local_file_path = ? || substr(local_file_path, ?)
+                                WHERE substr(local_file_path, 1, ?) = ?""",
+                             [(current_date, new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix) for old_prefix, new_prefix, _ in moved])
+            if artifact == 'original':
+                conn.executemany("UPDATE SourceFile SET status = 'deleted', updated_date = ? WHERE source_file_name = ?",
+                                 [(current_date, source_file_name) for _, _, source_file_names in moved for source_file_name in source_file_names])
+        moved_count += len(moved)
+    logging.info(f"{moved_count} {artifact} folder(s) moved to the deleted folder.")
+    return moved_count
+
+# Function to pack expired artifact folders into one archive each, next to where the folder was, e.g.
+# completed/<yymmdd>/<name>/chunks.tar.gz. Their rows get status 'archived' and the archive's path.
+# Returns (folders archived, bytes reclaimed).
+def archive_artifacts(conn, expired_folders, artifact):
+    archived_count = 0
+    reclaimed_bytes = 0
+    current_date = datetime.now().strftime("%y-%m-%d")
+    compression = config.archive_compression
+    for batch in batches(expired_folders, config.retention_batch_size):
+        archived = []
+        for artifact_folder, _ in batch:
+            archive_path = f"{artifact_folder}.tar" + (f".{compression}" if compression else "")
+            temporary_path = f"{archive_path}.{os.getpid()}.tmp"
+            try:
+                folder_bytes = reclaimable_bytes(artifact_folder)
+                with tarfile.open(temporary_path, f"w:{compression}") as archive:
+                    archive.add(artifact_folder, arcname=artifact)
+                os.replace(temporary_path, archive_path)
+                shutil.rmtree(artifact_folder)
+                reclaimed_bytes += folder_bytes - os.path.getsize(archive_path)
+                archived.append((artifact_folder + os.sep, archive_path))
+            except (OSError, tarfile.TarError) as e:
+                logging.error(f"Error archiving {artifact_folder}: {e}")
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+
+        with database_lock, conn:
+            conn.executemany("""UPDATE ProcessedFiles SET status = 'archived', updated_date = ?, archive_path = ?
+                                WHERE substr(local_file_path, 1, ?) = ?""",
+                             [(current_date, archive_path, len(prefix), prefix) for prefix, archive_path in archived])
+        archived_count += len(archived)
+    logging.info(f"{archived_count} {artifact} folder(s) archived.")
+    return archived_count, reclaimed_bytes
+
+# Function to remove the artifact folders deleted more than retention_grace_days ago, their rows get status 'purged'.
+# Returns (folders purged, bytes reclaimed).
+def purge_deleted_artifacts(conn, deleted_folder):
+    folders = set()
+    rows = conn.execute("SELECT local_file_path FROM ProcessedFiles WHERE status = 'deleted' AND updated_date < ?",
+                        (cutoff_date(config.retention_grace_days),))
+    for (local_file_path,) in rows:
+        path_parts = os.path.relpath(local_file_path, deleted_folder).split(os.sep)
+        if len(path_parts) >= 4 and path_parts[0] != os.pardir:
+            folders.add(os.path.join(deleted_folder, *path_parts[:3]))
+
+    purged_count = 0
+    reclaimed_bytes = 0
+    current_date = datetime.now().strftime("%y-%m-%d")
+    for batch in batches(sorted(folders), config.retention_batch_size):
+        purged = []
+        for artifact_folder in batch:
+            try:
+                if os.path.exists(artifact_folder):
+                    reclaimed_bytes += reclaimable_bytes(artifact_folder)
+                    shutil.rmtree(artifact_folder)
+                purged.append(artifact_folder + os.sep)
+            except OSError as e:
+                logging.error(f"Error purging {artifact_folder}: {e}")
+
+        with database_lock, conn:
+            conn.executemany("UPDATE ProcessedFiles SET status = 'purged', updated_date = ? WHERE status = 'deleted' AND substr(local_file_path, 1, ?) = ?",
+                             [(current_date, len(prefix), prefix) for prefix in purged])
+        purged_count += len(purged)
+    logging.info(f"{purged_count} deleted folder(s) purged.")
+    return purged_count, reclaimed_bytes
+
+# Function to remove the folders of a directory tree left empty by purging, keeping the directory itself
+def delete_empty_folders(folder):
+    for root, dirs, files in os.walk(folder, topdown=False):
+        if root != folder and not os.listdir(root):
+            os.rmdir(root)
+
+# Function to apply the retention policies to the completed recordings and purge what was deleted long enough ago.
+# With dry_run nothing is changed and the expired folders are only counted.
+# Returns (folders deleted, folders archived, folders purged, bytes reclaimed).
+def apply_retention(database_name, completed_folder, deleted_folder, dry_run=False):
+    conn = get_connection(database_name)
+    deleted_count = archived_count = reclaimed_bytes = 0
+    for artifact, (action, days) in config.retention_policies.items():
+        expired_folders = expired_artifact_folders(conn, completed_folder, artifact, days)
+        if dry_run:
+            logging.info(f"{len(expired_folders)} {artifact} folder(s) older than {days} day(s) would be {action}d.")
+            if action == 'delete':
+                deleted_count += len(expired_folders)
+            else:
+                archived_count += len(expired_folders)
+        elif action == 'delete':
+            deleted_count += delete_artifacts(conn, expired_folders, artifact, completed_folder, deleted_folder)
+        else:
+            folders_archived, folder_bytes = archive_artifacts(conn, expired_folders, artifact)
+            archived_count += folders_archived
+            reclaimed_bytes += folder_bytes
+
+    purged_count = 0
+    if not dry_run:
+        purged_count, purged_bytes = purge_deleted_artifacts(conn, deleted_folder)
+        reclaimed_bytes += purged_bytes
+        delete_empty_folders(deleted_folder)
+    logging.info(f"Retention: {deleted_count} folder(s) deleted, {archived_count} archived, {purged_count} purged, {reclaimed_bytes} bytes reclaimed.")
+    return deleted_count, archived_count, purged_count, reclaimed_bytes
@@ -0,0 +1,63 @@
+import numpy as np
+
+from . import config
+
+
+# Silence-aware chunking: the PCM audio is reduced to one energy value per analysis frame of silence_frame_ms,
+# then each cut is placed at the quietest point between silence_min_chunk_ms and silence_max_chunk_ms after the
+# previous one. Everything is computed on whole NumPy arrays, so an hour of audio takes a fraction of a second.
+
+# Function to convert little-endian PCM bytes to float samples in [-1, 1], one row per frame
+def pcm_to_float(pcm_bytes, sample_width, channels):
+    if sample_width == 1:
+        samples = (np.frombuffer(pcm_bytes, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 3:
+        raw = np.frombuffer(pcm_bytes, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        # The high byte carries the sign
+        raw[:, 2] = np.where(raw[:, 2] > 127, raw[:, 2] - 256, raw[:, 2])
+        samples = (raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)).astype(np.float32) / 2 ** 23
+    else:
+        samples = np.frombuffer(pcm_bytes, dtype=f"<i{sample_width}").astype(np.float32) / 2 ** (8 * sample_width - 1)
+    return samples.reshape(-1, channels)
+
+# Function to compute the energy in dBFS of every analysis frame of the PCM buffers, which must hold whole sample frames
+def frame_energies_db(pcm_buffers, sample_width, channels, frame_rate):
+    frame_samples = max(1, frame_rate * config.silence_frame_ms // 1000)
+    energies = []
+    carry = np.zeros(0, dtype=np.float32)
+    for pcm_bytes in pcm_buffers:
+        mono = np.concatenate((carry, pcm_to_float(pcm_bytes, sample_width, channels).mean(axis=1)))
+        frame_count = len(mono) // frame_samples
+        energies.append(np.square(mono[:frame_count * frame_samples]).reshape(frame_count, frame_samples).mean(axis=1))
+        # Samples that don't fill a frame are carried over to the next buffer
+        carry = mono[frame_count * frame_samples:]
+    if len(carry):
+        energies.append(np.square(carry).mean(keepdims=True))
+    return 10 * np.log10(np.concatenate(energies) + 1e-10) if energies else np.zeros(0)
+
+# Function to place the cuts of a recording at silences, returns ([(start ms, end ms)], [silent chunk]).
+# A chunk is silent when none of its frames reaches silence_threshold_db.
+def silence_chunk_boundaries(energy_db, duration_ms):
+    frame_ms = config.silence_frame_ms
+    min_frames = max(1, config.silence_min_chunk_ms // frame_ms)
+    max_frames = max(min_frames, config.silence_max_chunk_ms // frame_ms)
+    total_frames = len(energy_db)
+
+    # Smooth over a few frames so a cut lands inside a pause rather than on a single quiet sample
+    smoothed = np.convolve(energy_db, np.ones(5) / 5, mode='same') if total_frames >= 5 else energy_db
+    cuts = []
+    start = 0
+    while total_frames - start > max_frames:
+        # Never leave a last chunk shorter than the minimum
+        low, high = start + min_frames, min(start + max_frames, total_frames - min_frames)
+        cut = low + int(np.argmin(smoothed[low:high + 1])) if high >= low else start + (total_frames - start) // 2
+        cuts.append(cut)
+        start = cut
+
+    frame_bounds = [0] + cuts + [total_frames]
+    boundaries = [(0 if index == 0 else frame_start * frame_ms + frame_ms // 2,
+                   duration_ms if index == len(cuts) else frame_end * frame_ms + frame_ms // 2)
+                  for index, (frame_start, frame_end) in enumerate(zip(frame_bounds, frame_bounds[1:]))]
+    silent_chunks = [bool(energy_db[frame_start:frame_end].max() < config.silence_threshold_db) if frame_end > frame_start else True
+                     for frame_start, frame_end in zip(frame_bounds, frame_bounds[1:])]
+    return boundaries, silent_chunks
@@ -0,0 +1,386 @@
+import os
+import stat
+import time
+import queue
+import shlex
+import hashlib
+import logging
+import paramiko
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import config
+from .database import get_connection, database_lock
+from .jobs import enqueue_jobs
+from .metrics import span, count, current_span
+
+
+# Function to open an SSH connection to the remote server
+def connect_ssh(hostname, port, username, password):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname, port, username, password)
+    if config.ssh_keepalive_interval > 0:
+        # Keepalives stop idle connections from being dropped and let a dead one be noticed
+        client.get_transport().set_keepalive(config.ssh_keepalive_interval)
+    return client
+
+# Function to open a pool of SFTP sessions spread round-robin over one or more SSH transports
+def open_sftp_pool(ssh, pool_size, transport_count=1):
+    clients = [ssh]
+    for _ in range(transport_count - 1):
+        clients.append(connect_ssh(*config.ssh_credentials()))
+
+    sftp_pool = queue.Queue()
+    for i in range(pool_size):
+        sftp_pool.put(clients[i % len(clients)].open_sftp())
+    logging.info(f"Opened {pool_size} SFTP sessions over {len(clients)} SSH transport(s).")
+    # Only the extra transports belong to the pool, the main client is closed by the caller
+    return sftp_pool, clients[1:]
+
+# Function to close every SFTP session in the pool and the extra SSH transports
+def close_sftp_pool(sftp_pool, extra_clients):
+    while not sftp_pool.empty():
+        sftp_pool.get_nowait().close()
+    for client in extra_clients:
+        client.close()
+
+# Function to connect to the remote server, returns a session of (SSH client, main SFTP session, SFTP pool or None,
+# extra SSH clients of the pool). The pool is opened when several download workers are configured.
+def open_remote_session():
+    try:
+        ssh = connect_ssh(*config.ssh_credentials())
+    except Exception as e:
+        logging.error(f"Error connecting to server")
+        raise e
+
+    try:
+        sftp_pool, pool_clients = None, []
+        if config.download_workers > 1:
+            sftp_pool, pool_clients = open_sftp_pool(ssh, config.sftp_pool_size, config.ssh_transport_count)
+        return ssh, ssh.open_sftp(), sftp_pool, pool_clients
+    except Exception:
+        ssh.close()
+        raise
+
+# Function to close everything opened by open_remote_session, ignoring connections that already died
+def close_remote_session(session):
+    ssh, sftp, sftp_pool, pool_clients = session
+    try:
+        if sftp_pool is not None:
+            close_sftp_pool(sftp_pool, pool_clients)
+        sftp.close()
+    except Exception as e:
+        logging.warning(f"Error closing SFTP sessions: {e}")
+    finally:
+        # Close the SSH connection
+        ssh.close()
+
+# Function to tell whether every SSH transport of a session is still up
+def remote_session_alive(session):
+    ssh, _, _, pool_clients = session
+    return all(client.get_transport() is not None and client.get_transport().is_active() for client in [ssh] + pool_clients)
+
+# Function to connect to the remote server for one run. Yields the main SFTP session and, when several
+# download workers are configured, a pool of SFTP sessions; everything is closed on exit.
+@contextmanager
+def remote_session():
+    session = open_remote_session()
+    try:
+        yield session[1], session[2]
+    finally:
+        close_remote_session(session)
+
+# Function to format a transfer rate for the logs
+def format_throughput(byte_count, elapsed):
+    rate = byte_count / elapsed if elapsed > 0 else 0
+    return f"{byte_count} bytes in {elapsed:.2f}s ({rate / (1024 * 1024):.2f} MB/s)"
+
+# Function to load the sync manifest once per run: remote path -> (size, mtime) of the last synced copy
+def load_sync_manifest(database_name):
+    cursor = get_connection(database_name).cursor()
+    cursor.execute("SELECT remote_path, file_size, mtime FROM SyncManifest")
+    return {remote_file_path: (file_size, mtime) for remote_file_path, file_size, mtime in cursor.fetchall()}
+
+# Function to decide in memory which remote WAV files are new or changed since the last sync
+def select_changed_files(files, remote_folder_path, manifest):
+    changed_files = []
+    for item in files:
+        if not item.filename.endswith('.wav'):
+            continue
+        remote_file_path = os.path.join(remote_folder_path, item.filename)
+        if manifest.get(remote_file_path) != (item.st_size, item.st_mtime):
+            changed_files.append(item)
+    return changed_files
+
+# Function to keep the changed files that are no longer being uploaded: those listed with the same size and mtime
+# as at the previous poll, or last modified at least upload_settle_seconds ago. sightings maps remote path to the
+# (size, mtime) of the changed files at the previous poll and is replaced with this poll's.
+def select_settled_files(changed_files, remote_folder_path, sightings, now=None):
+    now = time.time() if now is None else now
+    previous_sightings = dict(sightings)
+    sightings.clear()
+    settled_files = []
+    for item in changed_files:
+        remote_file_path = os.path.join(remote_folder_path, item.filename)
+        sightings[remote_file_path] = (item.st_size, item.st_mtime)
+        if previous_sightings.get(remote_file_path) == (item.st_size, item.st_mtime) or now - item.st_mtime >= config.upload_settle_seconds:
+            settled_files.append(item)
+    if len(settled_files) < len(changed_files):
+        logging.info(f"{len(changed_files) - len(settled_files)} file(s) in '{remote_folder_path}' may still be uploading, left for the next poll.")
+    return settled_files
+
+# Function to record downloaded files in SourceFile and the sync manifest in one transaction
+def record_synced_files(database_name, synced_files):
+    synced_date = datetime.now().strftime("%y-%m-%d")
+    conn = get_connection(database_name)
+    with database_lock, conn:
+        # A changed file is downloaded again under the same name, so reset its SourceFile row
+        conn.executemany("""INSERT INTO SourceFile (source_file_name, local_file_path, file_size, status, created_date, checksum) VALUES (?, ?, ?, 'pending', ?, ?)
+                            ON CONFLICT(source_file_name) DO UPDATE SET local_file_path = excluded.local_file_path, file_size = excluded.file_size,
+                            status = 'pending', updated_date = excluded.created_date, checksum = excluded.checksum""",
+                         [(os.path.basename(local_file_path), local_file_path, file_size, synced_date, checksum)
+                          for _, file_size, _, local_file_path, checksum in synced_files])
+        conn.executemany("INSERT OR REPLACE INTO SyncManifest (remote_path, file_size, mtime, local_file_path, checksum, synced_date) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(remote_file_path, file_size, mtime, local_file_path, checksum, synced_date)
+                          for remote_file_path, file_size, mtime, local_file_path, checksum in synced_files])
+        # Every downloaded file is queued for conversion along with its SourceFile row
+        enqueue_jobs(conn, [(local_file_path, os.path.basename(os.path.dirname(local_file_path))) for _, _, _, local_file_path, _ in synced_files])
+    logging.info(f"Recorded {len(synced_files)} synced file(s) in the database.")
+
+# Function to name the remote day folders from start_date to end_date, e.g. {'251014', '251015'}
+def day_folder_names(start_date, end_date):
+    return {(start_date + timedelta(days=offset)).strftime("%y%m%d") for offset in range((end_date - start_date).days + 1)}
+
+# Function to download folders from remote server, today's unless folder_dates names other day folders.
+# Returns the number of files downloaded, or None if none of the folders exists.
+def download_folders_from_remote(sftp, remote_path, local_input_folder, database_name, sftp_pool=None, on_downloaded=None, folder_dates=None):
+    # List files and directories in the remote 
+    try:
+        files = sftp.listdir_attr(remote_path)
+    except Exception as e:
+        logging.error(f"Error listing files in remote path '{remote_path}': {str(e)}")
+        return None
+
+    if folder_dates is None:
+        folder_dates = {datetime.now().strftime("%y%m%d")}
+    remote_folder_paths = sorted(os.path.join(remote_path, item.filename) for item in files
+                                 if stat.S_ISDIR(item.st_mode) and item.filename in folder_dates)
+    if not remote_folder_paths:
+        return None
+
+    # Load the manifest once, every folder is checked against it in memory
+    manifest = load_sync_manifest(database_name)
+
+    # Scan the folders concurrently, then download from all of them with one shared limit on transfers
+    changed_files = scan_folders(sftp, remote_folder_paths, manifest, sftp_pool)
+    return download_changed_files(sftp, [(remote_folder_path, item) for remote_folder_path in remote_folder_paths for item in changed_files[remote_folder_path]],
+                                  local_input_folder, database_name, sftp_pool, manifest, on_downloaded)
+
+# Function to read the remote (size, mtime) a part-file was started from, None when it was not recorded
+def read_part_source(part_file_path):
+    try:
+        with open(part_file_path + config.part_source_suffix) as source_file:
+            file_size, mtime = source_file.read().split()
+            return int(file_size), int(mtime)
+    except (OSError, ValueError):
+        return None
+
+# Function to copy a remote file into a local part-file, resuming from the bytes already there.
+# The remote size and mtime are kept next to the part-file, and a part-file of another version of the
+# remote file is started over rather than spliced onto the new data.
+# The SHA-256 is computed while writing, so the downloaded data is never read back.
+def transfer_file(sftp, remote_file_path, part_file_path, file_size, mtime):
+    checksum = hashlib.sha256()
+    offset = os.path.getsize(part_file_path) if os.path.exists(part_file_path) else 0
+    if offset and read_part_source(part_file_path) != (file_size, int(mtime)):
+        logging.info(f"'{remote_file_path}' changed since its part-file was written, starting over.")
+        offset = 0
+    if offset > file_size:
+        # The part-file belongs to an older, larger version of the remote file
+        offset = 0
+    if not offset:
+        with open(part_file_path + config.part_source_suffix, 'w') as source_file:
+            source_file.write(f"{file_size} {int(mtime)}")
+    if offset:
+        # Only the prefix written by an earlier attempt has to be hashed again
+        with open(part_file_path, 'rb') as part_file:
+            for data in iter(lambda: part_file.read(1024 * 1024), b''):
+                checksum.update(data)
+        logging.info(f"Resuming '{remote_file_path}' from byte {offset} of {file_size}.")
+
+    with sftp.open(remote_file_path, 'rb') as remote_file, open(part_file_path, 'r+b' if offset else 'wb') as local_file:
+        remote_file.seek(offset)
+        local_file.seek(offset)
+        local_file.truncate()
+        if file_size - offset >= config.prefetch_threshold:
+            remote_file.prefetch(file_size)
+        # Reads stop at the size the file was listed with, so a file still growing is not read past it
+        remaining_bytes = file_size - offset
+        while remaining_bytes > 0:
+            data = remote_file.read(min(config.transfer_block_size, remaining_bytes))
+            if not data:
+                break
+            local_file.write(data)
+            checksum.update(data)
+            remaining_bytes -= len(data)
+        local_file.flush()
+        os.fsync(local_file.fileno())
+    return checksum.hexdigest()
+
+# Function to get the SHA-256 of a remote file by running sha256sum on the server, None if it is not available.
+# The channel times out, so a server that refuses commands or only runs sftp-server never blocks the download.
+def remote_checksum(sftp, remote_file_path):
+    channel = None
+    try:
+        channel = sftp.get_channel().get_transport().open_session()
+        channel.settimeout(config.remote_checksum_timeout)
+        channel.exec_command(f"sha256sum {shlex.quote(remote_file_path)}")
+        output = channel.makefile('r').read()
+        if channel.recv_exit_status() != 0:
+            return None
+        return output.split()[0].lower() if output else None
+    except Exception as e:
+        logging.warning(f"Could not compute remote checksum of '{remote_file_path}': {e}")
+        return None
+    finally:
+        if channel is not None:
+            channel.close()
+
+# Function to download a file, returns (local file path, checksum) or None if the download failed.
+# The data lands in a part-file that is renamed into place only once its size and checksum match.
+# parent_span is the stage span the download counts towards, by default the one open in this thread.
+def download_file(sftp, remote_file_path, local_directory_path, file_size=None, mtime=None, parent_span=None):
+    with span('download', os.path.basename(remote_file_path), parent_span):
+        return download_file_attempts(sftp, remote_file_path, local_directory_path, file_size, mtime)
+
+# Function to make up to transfer_attempts attempts at downloading a file, see download_file
+def download_file_attempts(sftp, remote_file_path, local_directory_path, file_size=None, mtime=None):
+    # Get the file name
+    file_name = os.path.basename(remote_file_path)
+    # Local file path
+    local_file_path = os.path.join(local_directory_path, file_name)
+    part_file_path = local_file_path + config.part_file_suffix
+    for attempt in range(1, config.transfer_attempts + 1):
+        try:
+            if file_size is None or mtime is None:
+                remote_stat = sftp.stat(remote_file_path)
+                file_size, mtime = remote_stat.st_size, remote_stat.st_mtime
+            # Download the file
+            start_time = time.monotonic()
+            checksum = transfer_file(sftp, remote_file_path, part_file_path, file_size, mtime)
+            elapsed = time.monotonic() - start_time
+
+            part_file_size = os.path.getsize(part_file_path)
+            if part_file_size != file_size:
+                raise IOError(f"size mismatch, expected {file_size} bytes, got {part_file_size}")
+            expected_checksum = remote_checksum(sftp, remote_file_path) if config.verify_remote_checksum else None
+            if expected_checksum is not None and expected_checksum != checksum:
+                # The part-file is corrupt, so the next attempt starts over
+                os.remove(part_file_path)
+                raise IOError(f"checksum mismatch, expected {expected_checksum}, got {checksum}")
+
+            os.replace(part_file_path, local_file_path)
+            os.remove(part_file_path + config.part_source_suffix)
+            count(bytes=file_size)
+            logging.info(f"Downloaded '{file_name}' from remote server to local directory: {format_throughput(file_size, elapsed)}")
+            return local_file_path, checksum
+        except Exception as e:
+            # Log the error, the next attempt resumes from the part-file
+            logging.error(f"Error downloading '{file_name}' (attempt {attempt} of {config.transfer_attempts}): {str(e)}")
+    return None
+
+# Function to download a file with an SFTP session borrowed from the pool
+def download_file_pooled(sftp_pool, remote_file_path, local_directory_path, file_size=None, mtime=None, parent_span=None):
+    sftp = sftp_pool.get()
+    try:
+        return download_file(sftp, remote_file_path, local_directory_path, file_size, mtime, parent_span)
+    finally:
+        sftp_pool.put(sftp)
+
+# Function to list a remote day folder and keep the WAV files new or changed since the last sync
+def scan_folder(sftp, remote_folder_path, manifest):
+    files = [item for item in sftp.listdir_attr(remote_folder_path) if not stat.S_ISDIR(item.st_mode)]
+    changed_files = select_changed_files(files, remote_folder_path, manifest)
+    logging.info(f"{len(changed_files)} of {len(files)} file(s) in '{remote_folder_path}' are new or changed.")
+    return changed_files
+
+# Function to scan several day folders, concurrently over the SFTP pool when there is one.
+# Returns {remote folder path: changed files}; a folder that cannot be listed has none.
+def scan_folders(sftp, remote_folder_paths, manifest, sftp_pool=None):
+    def scan(remote_folder_path):
+        session = sftp if sftp_pool is None else sftp_pool.get()
+        try:
+            return scan_folder(session, remote_folder_path, manifest)
+        except Exception as e:
+            logging.error(f"Error listing files in remote folder '{remote_folder_path}': {str(e)}")
+            return []
+        finally:
+            if sftp_pool is not None:
+                sftp_pool.put(session)
+
+    if sftp_pool is None or len(remote_folder_paths) == 1:
+        return {remote_folder_path: scan(remote_folder_path) for remote_folder_path in remote_folder_paths}
+    with ThreadPoolExecutor(max_workers=config.download_workers) as executor:
+        return dict(zip(remote_folder_paths, executor.map(scan, remote_folder_paths)))
+
+# Function to download (remote folder path, file) pairs into the matching local day folders, with at most
+# download_workers transfers at once whichever folders they come from.
+# When on_downloaded is given, each file is recorded and passed to it as soon as its download completes,
+# otherwise the files are recorded in one batch. Returns the number of files downloaded.
+def download_changed_files(sftp, changed_files, local_input_folder, database_name, sftp_pool=None, manifest=None, on_downloaded=None):
+    # Create the local directories if they don't exist
+    local_directory_paths = {}
+    for remote_folder_path, _ in changed_files:
+        if remote_folder_path not in local_directory_paths:
+            local_directory_paths[remote_folder_path] = os.path.join(local_input_folder, os.path.basename(remote_folder_path))
+            os.makedirs(local_directory_paths[remote_folder_path], exist_ok=True)
+
+    synced_files = []
+    def file_downloaded(remote_folder_path, item, result):
+        if not result:
+            return
+        synced_file = (os.path.join(remote_folder_path, item.filename), item.st_size, item.st_mtime, result[0], result[1])
+        synced_files.append(synced_file)
+        # Keep the in-memory manifest current for callers that reuse it across polls
+        if manifest is not None:
+            manifest[synced_file[0]] = (item.st_size, item.st_mtime)
+        if on_downloaded is not None:
+            # The SourceFile row must exist before the conversion stage can update it
+            record_synced_files(database_name, [synced_file])
+            on_downloaded((result[0], os.path.basename(remote_folder_path), result[1]))
+
+    start_time = time.monotonic()
+    if sftp_pool is None:
+        for remote_folder_path, item in changed_files:
+            file_downloaded(remote_folder_path, item, download_file(sftp, os.path.join(remote_folder_path, item.filename),
+                                                                    local_directory_paths[remote_folder_path], item.st_size, item.st_mtime))
+    else:
+        # Fan the files out over the worker threads, each borrowing a session from the pool.
+        # The stage span is passed along, as the worker threads have none open.
+        stage_span = current_span()
+        with ThreadPoolExecutor(max_workers=config.download_workers) as executor:
+            futures = {executor.submit(download_file_pooled, sftp_pool, os.path.join(remote_folder_path, item.filename),
+                                       local_directory_paths[remote_folder_path], item.st_size, item.st_mtime, stage_span): (remote_folder_path, item)
+                       for remote_folder_path, item in changed_files}
+            for future in as_completed(futures):
+                file_downloaded(*futures[future], future.result())
+    elapsed = time.monotonic() - start_time
+
+    downloaded_bytes = sum(file_size for _, file_size, _, _, _ in synced_files)
+    logging.info(f"Downloaded {len(synced_files)} file(s) from {len(local_directory_paths)} folder(s): {format_throughput(downloaded_bytes, elapsed)}")
+    if synced_files and on_downloaded is None:
+        record_synced_files(database_name, synced_files)
+    return len(synced_files)
+
+# Function to download the new or changed files of one remote day folder, returns the number downloaded.
+# With sightings, kept by the caller between polls, only the files that stopped changing are downloaded.
+def download_folder(sftp, remote_folder_path, local_input_folder, database_name, sftp_pool=None, manifest=None, on_downloaded=None, sightings=None):
+    if manifest is None:
+        manifest = load_sync_manifest(database_name)
+    changed_files = scan_folder(sftp, remote_folder_path, manifest)
+    if sightings is not None:
+        changed_files = select_settled_files(changed_files, remote_folder_path, sightings)
+    return download_changed_files(sftp, [(remote_folder_path, item) for item in changed_files], local_input_folder,
+                                  database_name, sftp_pool, manifest, on_downloaded)
@@ -0,0 +1,81 @@
+import os
+import mmap
+import struct
+
+from . import config
+
+
+# WAV format tags the converter accepts: integer PCM and IEEE float, also when wrapped in WAVE_FORMAT_EXTENSIBLE
+wave_format_pcm = 1
+wave_format_float = 3
+wave_format_extensible = 0xFFFE
+
+# Function to read the RIFF, fmt and data headers of a wav file. The file is memory-mapped so only the pages
+# holding the headers are read, however long the recording. Returns (format tag, channels, frame rate,
+# sample width, data offset, data bytes, duration ms); raises ValueError with the reason the file is unusable.
+def read_wav_header(wav_file_path):
+    with open(wav_file_path, 'rb') as wav_file:
+        file_size = os.fstat(wav_file.fileno()).st_size
+        if file_size < 12:
+            raise ValueError(f"file is {file_size} bytes, too short for a RIFF header")
+        with mmap.mmap(wav_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                return parse_wav_header(data, file_size)
+            except struct.error:
+                raise ValueError("malformed RIFF chunk headers")
+
+# Function to walk the RIFF chunks of a mapped wav file up to its data chunk, see read_wav_header
+def parse_wav_header(data, file_size):
+    riff_id, riff_size, wave_id = struct.unpack_from('<4sI4s', data, 0)
+    if riff_id != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError("not a RIFF/WAVE file")
+    if riff_size + 8 > file_size:
+        raise ValueError(f"truncated: RIFF header declares {riff_size + 8} bytes, the file has {file_size}")
+
+    wav_format = None
+    offset = 12
+    while offset + 8 <= file_size:
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+        chunk_offset = offset + 8
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise ValueError(f"fmt chunk of {chunk_size} bytes is too short")
+            format_tag, channels, frame_rate, _, block_align, bits_per_sample = struct.unpack_from('<HHIIHH', data, chunk_offset)
+            if format_tag == wave_format_extensible and chunk_size >= 40:
+                # The real format is the first two bytes of the SubFormat GUID
+                format_tag, = struct.unpack_from('<H', data, chunk_offset + 24)
+            wav_format = format_tag, channels, frame_rate, block_align, bits_per_sample
+        elif chunk_id == b'data':
+            if wav_format is None:
+                raise ValueError("data chunk before the fmt chunk")
+            if chunk_offset + chunk_size > file_size:
+                raise ValueError(f"truncated: data chunk declares {chunk_size} bytes, the file holds {file_size - chunk_offset}")
+            return check_wav_format(wav_format, chunk_offset, chunk_size)
+        # Chunks are padded to an even size
+        offset = chunk_offset + chunk_size + (chunk_size & 1)
+    raise ValueError("no data chunk" if wav_format is not None else "no fmt chunk")
+
+# Function to check the format of a wav file against what the converter supports and the duration limits, see read_wav_header
+def check_wav_format(wav_format, data_offset, data_bytes):
+    format_tag, channels, frame_rate, block_align, bits_per_sample = wav_format
+    if format_tag not in (wave_format_pcm, wave_format_float):
+        raise ValueError(f"unsupported format tag {format_tag:#06x}")
+    sample_width = bits_per_sample // 8
+    if not channels or not frame_rate or bits_per_sample % 8 or sample_width not in (1, 2, 3, 4, 8):
+        raise ValueError(f"invalid sample format: {channels} channel(s), {frame_rate} Hz, {bits_per_sample} bits")
+    if block_align != channels * sample_width:
+        raise ValueError(f"block align {block_align} does not match {channels} channel(s) of {sample_width} byte(s)")
+    if data_bytes < block_align:
+        raise ValueError("no audio in the data chunk")
+
+    duration_ms = round(data_bytes // block_align * 1000 / frame_rate)
+    if duration_ms < config.wav_min_duration_ms:
+        raise ValueError(f"duration {duration_ms} ms is shorter than {config.wav_min_duration_ms} ms")
+    if config.wav_max_duration_ms and duration_ms > config.wav_max_duration_ms:
+        raise ValueError(f"duration {duration_ms} ms is longer than {config.wav_max_duration_ms} ms")
+    return format_tag, channels, frame_rate, sample_width, data_offset, data_bytes, duration_ms
+
+# Function to tell whether a wav file can be streamed to the encoder as raw integer PCM
+def is_streamable(wav_header):
+    format_tag, channels, frame_rate, sample_width = wav_header[:4]
+    return format_tag == wave_format_pcm and sample_width in config.pcm_formats
@@ -0,0 +1,88 @@
+import os
+import signal
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from . import config
+from .sync import open_remote_session, close_remote_session, remote_session_alive, load_sync_manifest, download_folder
+from .convert import convert_wav_to_mp3, delete_empty_main_folders
+from .metrics import span, flush_spans
+
+
+# The watcher keeps one SSH connection open with keepalives, polls today's remote folder every few seconds
+# and converts what arrived right away. A dropped connection is reopened with an increasing delay, and the
+# sync manifest and conversion processes are kept between polls so an idle poll costs one directory listing.
+
+# Function to download and convert the files that arrived in today's remote folder, returns the number downloaded
+def poll_today(session, manifest, executor, sightings):
+    _, sftp, sftp_pool, _ = session
+    remote_folder_path = os.path.join(config.remote_path, datetime.now().strftime("%y%m%d"))
+    try:
+        downloaded_count = download_folder(sftp, remote_folder_path, config.input_folder, config.database_name, sftp_pool, manifest, sightings=sightings)
+    except FileNotFoundError:
+        # Today's folder has not been created on the server yet
+        return 0
+
+    if downloaded_count:
+        with span('convert'):
+            convert_wav_to_mp3(config.input_folder, config.processing_folder, config.completed_folder, config.failed_folder,
+                               config.database_name, executor=executor)
+        delete_empty_main_folders(config.input_folder)
+        delete_empty_main_folders(config.processing_folder)
+    return downloaded_count or 0
+
+# Function to poll the remote server until stopped with SIGINT or SIGTERM
+def watch(poll_interval=None):
+    poll_interval = poll_interval or config.watch_interval
+    stop_event = threading.Event()
+    def request_stop(signum, frame):
+        logging.info(f"Signal {signum} received, stopping the watcher.")
+        stop_event.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Files left in the input folder by an earlier run are converted before watching starts
+    executor = ProcessPoolExecutor(max_workers=config.conversion_workers) if config.conversion_workers > 1 else None
+    convert_wav_to_mp3(config.input_folder, config.processing_folder, config.completed_folder, config.failed_folder,
+                       config.database_name, executor=executor)
+
+    manifest = load_sync_manifest(config.database_name)
+    # Size and mtime of the changed files at the previous poll, to tell finished uploads from those in progress
+    sightings = {}
+    session = None
+    reconnect_delay = 1
+    logging.info(f"Watching '{config.remote_path}' every {poll_interval}s.")
+    try:
+        while not stop_event.is_set():
+            try:
+                if session is not None and not remote_session_alive(session):
+                    logging.warning("Connection to the server lost, reconnecting.")
+                    close_remote_session(session)
+                    session = None
+                if session is None:
+                    session = open_remote_session()
+                    logging.info("Connected to the server.")
+                reconnect_delay = 1
+
+                downloaded_count = poll_today(session, manifest, executor, sightings)
+                if downloaded_count:
+                    logging.info(f"{downloaded_count} new file(s) downloaded and converted.")
+                # The watcher never finishes its run, so the timings of every poll are written as it goes
+                flush_spans(config.database_name)
+            except Exception as e:
+                logging.error(f"Error while watching the remote folder: {e}. Retrying in {reconnect_delay}s.")
+                if session is not None:
+                    close_remote_session(session)
+                    session = None
+                stop_event.wait(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, config.reconnect_max_delay)
+                continue
+            stop_event.wait(poll_interval)
+    finally:
+        if session is not None:
+            close_remote_session(session)
+        if executor is not None:
+            executor.shutdown()
+    logging.info("Watcher stopped.")